@@ -88,16 +88,29 @@ def _load_name_dict():
     return name_dict
 
 
+def _build_name_emails(names):
+    """Get {full_name: set of emails} from email: name dictionary."""
+    name_emails = {}
+    for email, full_name in names.items():
+        name_emails.setdefault(full_name, set()).add(email)
+    return name_emails
+
+
 def update_name_dict():
-    global name_dict
+    global name_dict, name_emails
     name_dict.clear()
     new_dict = _load_name_dict()
     name_dict.update(new_dict)
+    name_emails.clear()
+    name_emails.update(_build_name_emails(new_dict))
 
 
 name_dict = _load_name_dict()
+name_emails = _build_name_emails(name_dict)
 update_members_dict()
 update_table_dict()
 
 from app import models
 from app import routes
+from .scheduler import scheduler
+scheduler.start()
@@ -1,11 +1,14 @@
 import logging
+import threading
 from collections import OrderedDict, namedtuple
 from datetime import date, datetime, timezone, timedelta
 
 import numpy as np
 import pandas as pd
+import httplib2
 from flask import current_app
 from google.oauth2 import service_account
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
 
 from .helpers import parse_timestamp_str
@@ -16,17 +19,19 @@ from .models import User
 logger = logging.getLogger(__name__)
 
 
-def get_service_handles():
-    """Get dictionary of {service_name: service_handle}."""
+def get_delegated_credentials():
+    """Get service account credentials acting as CREDENTIALS_AS_USER."""
     SERVICE_ACCOUNT_FILE = current_app.config['SERVICE_ACCOUNT_FILE']
     # GROUP_KEY = current_app.config['GROUP_KEY']
     SCOPES = current_app.config['SCOPES']
 
     credentials = service_account.Credentials.from_service_account_file(
         SERVICE_ACCOUNT_FILE, scopes=SCOPES)
-    delegated_credentials = credentials.with_subject(
-        current_app.config['CREDENTIALS_AS_USER'])
+    return credentials.with_subject(current_app.config['CREDENTIALS_AS_USER'])
+
 
+def get_service_handles(delegated_credentials):
+    """Get dictionary of {service_name: service_handle}."""
     dir_service = build('admin', 'directory_v1', credentials=delegated_credentials, cache_discovery=False)
     files_service = build('drive', 'v3', credentials=delegated_credentials, cache_discovery=False)
     cal_service = build('calendar', 'v3', credentials=delegated_credentials, cache_discovery=False)
@@ -37,7 +42,23 @@ def get_service_handles():
     }
 
 
-SERVICE_HANDLES = get_service_handles()
+DELEGATED_CREDENTIALS = get_delegated_credentials()
+SERVICE_HANDLES = get_service_handles(DELEGATED_CREDENTIALS)
+_thread_local = threading.local()
+
+
+def get_thread_http():
+    """Get authorized http transport for the current thread.
+
+    Service handles share one httplib2.Http, which is not thread-safe. Requests
+    built from SERVICE_HANDLES in worker threads are executed with a
+    per-thread transport instead, e.g. request.execute(http=get_thread_http()).
+    """
+    http = getattr(_thread_local, 'http', None)
+    if http is None:
+        http = AuthorizedHttp(DELEGATED_CREDENTIALS, http=httplib2.Http())
+        _thread_local.http = http
+    return http
 
 
 def get_members_dict():
@@ -264,10 +285,17 @@ class RecentDocs(ApiTable):
 
 class ReviewTable(ApiTable):
 
-    def __init__(self, root_folder_id, root_folder_title):
+    def __init__(self, root_folder_id, root_folder_title, **crawl_options):
+        """Table of files in Drive folder tree.
+
+        Args:
+            crawl_options: max_depth, include, exclude, on_level, to limit
+                the folders listed (see drive.file_tree_to_df).
+        """
         self.refresh_minutes = 5
         self.root_folder_id = root_folder_id
         self.root_folder_title = root_folder_title
+        self.crawl_options = crawl_options
         super().__init__()
 
     cols_show = OrderedDict([
@@ -280,7 +308,8 @@ class ReviewTable(ApiTable):
     # cols_other = ['date_created', 'url', 'icon', 'kind', 'thumb']
 
     def refresh_df(self):
-        files = file_tree_to_df(self.root_folder_id, self.root_folder_title)
+        files = file_tree_to_df(self.root_folder_id, self.root_folder_title,
+                                **self.crawl_options)
         files = files[list(ReviewTable.cols_show) + ReviewTable.cols_other]
         files = files.sort_values(['path', 'title'])
         self._df = files
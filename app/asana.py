@@ -1,13 +1,24 @@
 import os
+import re
+import json
+import time
 import logging
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+import pyarrow as pa
+from pyarrow import feather
 import datetime as dt
-from collections import OrderedDict, defaultdict
+from collections import OrderedDict, defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
+from operator import itemgetter
 
 import numpy as np
 import pandas as pd
 
 from . import app, db, MEMBERS_DICT, name_dict, DATA_DIR
+from .snapshots import SnapshotStore
 
 
 logger = logging.getLogger(__name__)
@@ -15,9 +26,12 @@ logger = logging.getLogger(__name__)
 TOKEN = app.config['ASANA_TOKEN']
 WORKSPACE_ID = app.config['ASANA_WORKSPACE_ID']
 TEAM_ID = app.config['ASANA_TEAM_ID']
+MAX_WORKERS = app.config['ASANA_MAX_WORKERS']
 # DEMO_PROJ_ID = '970226393478089'
 # DEMO_TASK_ID = '982320718273845'
 ASANA_HOST = 'https://app.asana.com/api/1.0/'
+PAGE_SIZE = 100  # maximum page size allowed by Asana
+BATCH_SIZE = 10  # maximum actions per batch request allowed by Asana
 COLORMAP = defaultdict(lambda: '#b7bfc6')
 COLORMAP.update({
         'dark-pink': '#ea4e9d',
@@ -29,21 +43,533 @@ COLORMAP.update({
         'light-purple': '#aa62e3',
     })
 
-# OBJECTS POPULATED IN THIS MODULE: asana_ids, projects
-asana_ids = None
-projects = None
-tasks = None
-links = None
+# SNAPSHOT POPULATED IN THIS MODULE: asana_ids, projects, tasks, links.
+# tasks, links are the combined view of per-project partitions.
+AsanaSnapshot = namedtuple('AsanaSnapshot', [
+    'generation', 'asana_ids', 'projects', 'tasks', 'links', 'task_index',
+    'sync_state', 'email_index', 'notes', 'partitions'])
+TABLE_NAMES = ['asana_ids', 'projects']
+# tasks, links, notes are stored per project, as e.g. 'tasks-<project_id>'
+PARTITION_TABLES = ['tasks', 'links', 'notes']
+snapshot = AsanaSnapshot(None, None, None, None, None, None, None, {}, None, {})
+_publish_lock = threading.Lock()
+_tasks_lock = threading.RLock()  # serializes read-modify-write of tasks, links
+
+TASK_KEEP_COLS = ['name', 'due_on', 'modified_at', 'html_notes', 'assignee']
+TASK_EXTRA_FIELDS = ['projects', 'memberships.(section|project).name']
+# compact listing, for tasks that are then fetched once (see _refresh_tasks_links)
+TASK_LIST_FIELDS = ['modified_at', 'memberships.(section|project).name']
+LINK_COLS = ['task_id', 'project_id', 'project_name', 'section_id',
+             'section_name']
+# repeated values stored as categoricals in memory and on disk
+TASK_CATEG_COLS = ['assignee']
+LINK_CATEG_COLS = ['project_id', 'project_name', 'section_id', 'section_name']
 
 nan = np.nan
 nat = pd._libs.tslibs.nattype.NaT
 
 
 # LOCAL FILES FOR STORING LOADED DATA
-ids_local = os.path.join(DATA_DIR, 'asana_ids.feather')
-projects_local = os.path.join(DATA_DIR, 'projects.feather')
-tasks_local = os.path.join(DATA_DIR, 'tasks.feather')
-links_local = os.path.join(DATA_DIR, 'links.feather')
+store = SnapshotStore(os.path.join(DATA_DIR, 'asana'))
+# unversioned files used by earlier versions, migrated on first load
+legacy_files = {
+    'asana_ids': os.path.join(DATA_DIR, 'asana_ids.feather'),
+    'projects': os.path.join(DATA_DIR, 'projects.feather'),
+    'tasks': os.path.join(DATA_DIR, 'tasks.feather'),
+    'links': os.path.join(DATA_DIR, 'links.feather'),
+}
+legacy_sync_local = os.path.join(DATA_DIR, 'asana_sync.json')
+
+
+# SNAPSHOTS
+
+def get_snapshot():
+    """Get current AsanaSnapshot. Use one snapshot per request for consistency."""
+    return snapshot
+
+
+def load_snapshot():
+    """Load published snapshot, migrating files of earlier versions if necessary."""
+    global snapshot
+    generation, tables, meta = store.read(skip=['notes', 'notes-'])
+    if generation is None and all(os.path.exists(i) for i in legacy_files.values()):
+        logger.info("Migrating asana feather files to snapshot store.")
+        tables = {k: pd.read_feather(v) for k, v in legacy_files.items()}
+        meta = {'sync_state': None}
+        if os.path.exists(legacy_sync_local):
+            with open(legacy_sync_local) as f:
+                meta['sync_state'] = json.load(f)
+    elif generation is None:
+        logger.warning("No asana snapshot found. Reload to populate.")
+    if 'tasks' in tables:
+        _migrate_unpartitioned(generation, tables, meta)
+    else:
+        snapshot = _build_snapshot(generation, tables, meta)
+    log_memory_report()
+
+
+def _migrate_unpartitioned(generation, tables, meta):
+    """Publish single tasks, links tables of earlier versions as partitions."""
+    global snapshot
+    logger.info("Partitioning asana tasks by project.")
+    tables = dict(tables)
+    # date flags are computed when read; drop any saved by older versions
+    tasks = tables.pop('tasks').drop(columns=['due_this_year', 'overdue'],
+                                     errors='ignore')
+    links = tables.pop('links').astype({i: object for i in LINK_CATEG_COLS})
+    snapshot = _build_snapshot(generation, tables, meta)
+    if generation is not None and os.path.exists(store.path(generation, 'notes')):
+        snapshot = snapshot._replace(
+            notes=TaskNotes([store.path(generation, 'notes')]))
+    partitions = {
+        project_id: _make_partition(
+            project_id, tasks[tasks.task_id.isin(group.task_id)], group)
+        for project_id, group in links.groupby('project_id')}
+    _publish(asana_ids=snapshot.asana_ids, projects=snapshot.projects,
+             partitions=partitions)
+
+
+def _build_snapshot(generation, tables, meta):
+    """Build AsanaSnapshot from tables as stored."""
+    projects = tables.get('projects')
+    if projects is not None:
+        projects = projects.set_index('project_id')
+    stored = defaultdict(dict)  # {project_id: {table: df}}
+    for name, df in tables.items():
+        table, _, project_id = name.partition('-')
+        if project_id:
+            stored[project_id][table] = df
+    tasks, links, partitions = _compose(
+        {k: (v['tasks'], v['links']) for k, v in stored.items()})
+    task_index = TaskIndex(tasks, links) if tasks is not None else None
+    asana_ids = tables.get('asana_ids')
+    return AsanaSnapshot(generation, asana_ids, projects, tasks, links,
+                         task_index, meta.get('sync_state'),
+                         _build_email_index(asana_ids),
+                         _load_notes(generation, partitions), partitions)
+
+
+def _publish(**changes):
+    """Write new snapshot generation with changed values, then swap it in.
+
+    Only changed project partitions are written; the others are carried over
+    on disk and recomposed from the current tables in memory. Partitions of
+    projects no longer listed in projects are dropped.
+
+    Args:
+        **changes: new asana_ids, projects (dataframes) and/or sync_state
+            (dict). partitions (dict) holds {project_id: (tasks, links)} for
+            changed projects only, or None for a removed project. Other
+            tables carry over from current snapshot.
+    """
+    global snapshot
+    with _publish_lock:
+        current = snapshot
+        updates = changes.pop('partitions', {})
+        new = current._replace(**changes)
+        project_ids = set(current.partitions).union(updates)
+        removed = {k for k, v in updates.items() if v is None}
+        if new.projects is not None:
+            removed.update(project_ids.difference(new.projects.index))
+        project_ids.difference_update(removed)
+
+        stored = {}
+        for name in TABLE_NAMES:
+            if name in changes:
+                df = changes[name]
+                stored[name] = df.reset_index() if name == 'projects' else df
+        parts = {}
+        for project_id in project_ids:
+            if project_id not in updates:
+                parts[project_id] = _get_partition(current, project_id)
+                continue
+            tasks, notes = _split_notes(updates[project_id][0], current.notes)
+            tasks, links = _compact_tasks_links(tasks, updates[project_id][1])
+            parts[project_id] = (tasks, links)
+            stored.update(zip(_partition_names(project_id), [tasks, links, notes]))
+        carry = [i for i in TABLE_NAMES if i not in changes]
+        for project_id in project_ids.difference(updates):
+            carry.extend(_partition_names(project_id))
+        generation = store.write(stored, {'sync_state': new.sync_state},
+                                 carry=carry)
+        new = new._replace(generation=generation)
+        if updates or removed:
+            if removed:
+                logger.info("Dropped task partitions for projects: %s",
+                            sorted(removed))
+            tasks, links, partitions = _compose(parts)
+            new = new._replace(
+                tasks=tasks, links=links, partitions=partitions,
+                task_index=TaskIndex(tasks, links) if tasks is not None else None,
+                notes=_load_notes(generation, partitions))
+        if 'asana_ids' in changes:
+            new = new._replace(email_index=_build_email_index(new.asana_ids))
+        snapshot = new
+
+
+# PROJECT PARTITIONS
+
+def _partition_names(project_id):
+    """Get names of stored tasks, links, notes tables for project partition."""
+    return ['{}-{}'.format(i, project_id) for i in PARTITION_TABLES]
+
+
+def _get_partition(current, project_id):
+    """Get (tasks, links) partition for project from snapshot's combined tables.
+
+    Unknown projects give empty tables.
+    """
+    empty = np.array([], dtype=int)
+    task_pos, link_pos = current.partitions.get(project_id, (empty, empty))
+    return current.tasks.iloc[task_pos], current.links.iloc[link_pos]
+
+
+def _compose(parts):
+    """Combine project partitions into single tasks, links tables.
+
+    A task in several projects is stored in each of their partitions; the
+    most recently modified copy is kept.
+
+    Args:
+        parts (dict): {project_id: (tasks, links)}.
+    Returns:
+        tasks, links (pd.DataFrame): combined tables, or None if no partitions.
+        partitions (dict): {project_id: (task positions, link positions)} in
+            the combined tables.
+    """
+    if not parts:
+        return None, None, {}
+    project_ids = sorted(parts)
+    tasks = pd.concat([parts[i][0] for i in project_ids], ignore_index=True)
+    links = pd.concat([parts[i][1] for i in project_ids], ignore_index=True)
+    tasks = tasks.sort_values('modified_at', ascending=False, kind='mergesort') \
+        .drop_duplicates('task_id')
+    # same order however partitions were assembled: gids follow creation
+    tasks = tasks.sort_values(['due_on', 'task_id'], kind='mergesort')
+    tasks.reset_index(drop=True, inplace=True)
+    tasks, links = _compact_tasks_links(tasks, links)
+
+    # ROW POSITIONS OF EACH PARTITION IN COMBINED TABLES
+    task_positions = pd.Series(np.arange(len(tasks)), index=tasks.task_id.values)
+    link_groups = links.groupby('project_id', observed=True).indices
+    empty = np.array([], dtype=int)
+    partitions = {}
+    for project_id in project_ids:
+        link_pos = link_groups.get(project_id, empty)
+        task_ids = pd.unique(links.task_id.values[link_pos])
+        task_pos = task_positions.reindex(task_ids).dropna().astype(int).values
+        partitions[project_id] = (np.sort(task_pos), link_pos)
+    return tasks, links, partitions
+
+
+def _make_partition(project_id, tasks, parents):
+    """Build (tasks, links) partition for project from fetched tables.
+
+    Memberships in other projects are dropped: they belong to the partitions
+    of those projects.
+
+    Args:
+        project_id (str): Asana project gid.
+        tasks (pd.DataFrame): tasks, with task_id column.
+        parents (pd.DataFrame): task_parents (links) table.
+    """
+    links = parents[parents.project_id == project_id]
+    links = links.astype({i: object for i in LINK_CATEG_COLS})
+    links = links.drop_duplicates().reset_index(drop=True)
+    links['section_id'] = links['section_id'].fillna('0')  # use '0' for blanks
+    links['section_name'] = links['section_name'].fillna('')
+    tasks = tasks[tasks.task_id.isin(links.task_id)].drop_duplicates('task_id')
+    tasks = tasks.sort_values('due_on', kind='mergesort')
+    tasks.reset_index(drop=True, inplace=True)
+    return tasks, links
+
+
+def _merge_partition(partition, project_id, tasks, parents, touched_ids):
+    """Replace touched and fetched tasks in (tasks, links) partition.
+
+    Touched tasks that were not fetched (e.g. completed, deleted or removed
+    from the project) are dropped.
+    """
+    old_tasks, old_links = partition
+    stale = set(touched_ids).union(tasks.task_id)
+    tasks = pd.concat([old_tasks[~old_tasks.task_id.isin(stale)], tasks],
+                      axis=0, ignore_index=True)
+    parents = pd.concat([old_links[~old_links.task_id.isin(stale)], parents],
+                        axis=0, ignore_index=True)
+    return _make_partition(project_id, tasks, parents)
+
+
+def _load_notes(generation, project_ids):
+    """Get TaskNotes for partitions of generation, or None if there are none."""
+    if generation is None or not project_ids:
+        return None
+    return TaskNotes([store.path(generation, _partition_names(i)[2])
+                      for i in sorted(project_ids)])
+
+
+def _split_notes(tasks, current_notes):
+    """Split html_notes from tasks table.
+
+    Rows without notes (i.e. carried over from the current snapshot in a
+    merge) take their notes from current_notes.
+
+    Returns:
+        tasks (pd.DataFrame): tasks without html_notes column.
+        notes (pd.DataFrame): task_id, modified_at, html_notes table.
+    """
+    if 'html_notes' in tasks:
+        html_notes = tasks.html_notes.astype(object)
+    else:
+        html_notes = pd.Series(None, index=tasks.index, dtype=object)
+    missing = html_notes.isnull()
+    if missing.any() and current_notes is not None:
+        html_notes[missing] = current_notes.get(tasks.task_id[missing].values)
+    notes = pd.DataFrame({'task_id': tasks.task_id.values,
+                          'modified_at': tasks.modified_at.values,
+                          'html_notes': html_notes.fillna('').values})
+    return tasks.drop(columns=['html_notes'], errors='ignore'), notes
+
+
+def _compact_tasks_links(tasks, links):
+    """Store repeated ids and names as categoricals."""
+    tasks = tasks.astype({i: 'category' for i in TASK_CATEG_COLS})
+    links = links.astype({i: 'category' for i in LINK_CATEG_COLS})
+    return tasks, links
+
+
+class TaskNotes:
+    """Task html_notes, read on demand from memory-mapped feather files.
+
+    Only the notes for requested tasks are materialized as python strings.
+    Tasks in several project partitions use their most recently modified
+    notes.
+    """
+    schema = pa.schema([('task_id', pa.string()), ('modified_at', pa.string()),
+                        ('html_notes', pa.string())])
+
+    def __init__(self, paths):
+        self.paths = paths
+        self._table = pa.concat_tables([self._read(i) for i in paths])
+        self._positions = None  # {task_id: row}, built on first lookup
+        self._lock = threading.Lock()
+
+    def get(self, task_ids):
+        """Get list of html_notes for task_ids ('' where unknown)."""
+        if self._positions is None:
+            with self._lock:
+                if self._positions is None:
+                    ids = self._table.column('task_id').to_pylist()
+                    modified = self._table.column('modified_at').to_pylist()
+                    latest = {}  # {task_id: (modified_at, row)}
+                    for i, (task_id, mod) in enumerate(zip(ids, modified)):
+                        if task_id not in latest or (mod or '') > latest[task_id][0]:
+                            latest[task_id] = (mod or '', i)
+                    self._positions = {k: v[1] for k, v in latest.items()}
+        html_notes = self._table.column('html_notes')
+        rows = [self._positions.get(i) for i in task_ids]
+        return [html_notes[i].as_py() or '' if i is not None else ''
+                for i in rows]
+
+    @classmethod
+    def _read(cls, path):
+        """Read notes table, with types cast as empty tables may lack them."""
+        table = feather.read_table(path, memory_map=True)
+        # modified_at is missing from notes stored by earlier versions
+        columns = [table.column(i) if i in table.column_names
+                   else pa.array([None] * table.num_rows, type=pa.string())
+                   for i in cls.schema.names]
+        return pa.Table.from_arrays(columns, names=cls.schema.names) \
+            .cast(cls.schema)
+
+    @property
+    def nbytes(self):
+        return self._table.nbytes
+
+
+def memory_report(current=None):
+    """Get resident size in bytes of each table in snapshot.
+
+    Notes are memory-mapped, so their size is reported separately as
+    'notes (mapped)'.
+    """
+    current = current or snapshot
+    report = OrderedDict()
+    for name in ['asana_ids', 'projects', 'tasks', 'links']:
+        df = getattr(current, name)
+        if df is not None:
+            report[name] = int(df.memory_usage(index=True, deep=True).sum())
+    if current.notes is not None:
+        report['notes (mapped)'] = current.notes.nbytes
+    return report
+
+
+def log_memory_report():
+    for name, n_bytes in memory_report().items():
+        logger.info("Asana %s: %.1f kB.", name, n_bytes / 1024)
+
+
+# HTTP CLIENT
+
+class AsanaClient:
+    """Asana API client with pooled keep-alive connections and retries.
+
+    Rate-limited (429) and server error responses are retried with
+    exponential backoff, honoring the Retry-After header. Requests that are
+    not safe to repeat (POST by default) are only retried when rate-limited,
+    as Asana has not processed them. Request and byte counts are tracked per
+    endpoint, with gids replaced by '{gid}'.
+    """
+    retry_statuses = {429, 500, 502, 503, 504}
+
+    def __init__(self, token, host=ASANA_HOST, pool_size=10, timeout=30,
+                 max_retries=5, backoff_seconds=1):
+        self.host = host
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.session = requests.Session()
+        self.session.auth = (token, '')
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.stats = defaultdict(lambda: {'requests': 0, 'bytes': 0})
+        self._lock = threading.Lock()
+
+    def request(self, method, endpoint, idempotent=None, **kwargs):
+        """Send request, retrying on rate limits and transient errors.
+
+        Args:
+            method (str): HTTP method, e.g. 'GET'.
+            endpoint (str): path relative to API host, e.g. 'teams/123/users'.
+            idempotent (bool): whether request is safe to repeat after
+                transient errors. Defaults to True for GET requests only.
+            **kwargs: passed to requests.Session.request.
+        Returns:
+            r: http response object (final attempt).
+        """
+        url = '{}{}'.format(self.host, endpoint)
+        kwargs.setdefault('timeout', self.timeout)
+        if idempotent is None:
+            idempotent = method.upper() == 'GET'
+        retry_statuses = self.retry_statuses if idempotent else {429}
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            try:
+                r = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == self.max_retries or not idempotent:
+                    raise
+                reason = type(e).__name__
+            else:
+                self._record(endpoint, r)
+                if r.status_code not in retry_statuses \
+                        or attempt == self.max_retries:
+                    return r
+                reason = r.status_code
+                retry_after = r.headers.get('Retry-After')
+            wait = self._get_wait_seconds(attempt, retry_after)
+            logger.warning("Asana request to %s failed (%s). Retrying in %.1fs.",
+                           endpoint, reason, wait)
+            time.sleep(wait)
+
+    def get(self, endpoint, params=None, **kwargs):
+        return self.request('GET', endpoint, params=params, **kwargs)
+
+    def post(self, endpoint, json=None, **kwargs):
+        return self.request('POST', endpoint, json=json, **kwargs)
+
+    def get_batch(self, paths, fields=None):
+        """Send GET requests for several paths as a single batch request.
+
+        Actions answered with a retry status are resent, with backoff.
+
+        Args:
+            paths (list): up to BATCH_SIZE paths, e.g. '/tasks/123'.
+            fields (list): opt_fields for every action.
+        Returns:
+            list of (status_code, data) tuples, in path order.
+        """
+        options = {'fields': fields} if fields else {}
+        results = [None] * len(paths)
+        pending = list(range(len(paths)))
+        for attempt in range(self.max_retries + 1):
+            actions = [{'method': 'get', 'relative_path': paths[i],
+                        'options': options} for i in pending]
+            # batched actions are read-only, so safe to resend
+            r = self.post('batch', json={'data': {'actions': actions}},
+                          idempotent=True)
+            r.raise_for_status()
+            retry = []
+            for i, result in zip(pending, r.json()['data']):
+                status = result['status_code']
+                body = result.get('body') or {}
+                results[i] = (status, body.get('data'))
+                if status in self.retry_statuses:
+                    retry.append(i)
+            if not retry or attempt == self.max_retries:
+                return results
+            pending = retry
+            wait = self._get_wait_seconds(attempt)
+            logger.warning("%d Asana batch actions failed. Retrying in %.1fs.",
+                           len(retry), wait)
+            time.sleep(wait)
+
+    def _get_wait_seconds(self, attempt, retry_after=None):
+        if retry_after is not None:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        return self.backoff_seconds * 2 ** attempt
+
+    def _record(self, endpoint, r):
+        key = re.sub(r'\d+', '{gid}', endpoint.strip('/'))
+        with self._lock:
+            self.stats[key]['requests'] += 1
+            self.stats[key]['bytes'] += len(r.content)
+
+    def log_stats(self):
+        """Log request and byte counts per endpoint."""
+        with self._lock:
+            stats = sorted(self.stats.items())
+        for endpoint, counts in stats:
+            logger.info("Asana %s: %d requests, %d bytes.", endpoint,
+                        counts['requests'], counts['bytes'])
+
+
+client = AsanaClient(TOKEN, pool_size=MAX_WORKERS,
+                     timeout=app.config['ASANA_TIMEOUT'],
+                     max_retries=app.config['ASANA_MAX_RETRIES'])
+
+
+# PAGINATION
+
+def _iter_pages(endpoint, params=None, page_size=PAGE_SIZE):
+    """Yield pages (lists of records) from a paginated Asana collection.
+
+    Follows next_page.offset cursors until the collection is exhausted, so
+    only one page of the JSON response is held at a time.
+    """
+    params = dict(params or {}, limit=page_size)
+    n_pages = 0
+    while True:
+        r = client.get(endpoint, params=params)
+        r.raise_for_status()
+        body = r.json()
+        n_pages += 1
+        yield body['data']
+        next_page = body.get('next_page')
+        if not next_page:
+            break
+        params['offset'] = next_page['offset']
+    if n_pages > 1:
+        logger.info("Read %d pages from %s.", n_pages, endpoint)
+
+
+def _iter_collection(endpoint, params=None, page_size=PAGE_SIZE):
+    """Yield records from a paginated Asana collection as pages arrive."""
+    for page in _iter_pages(endpoint, params, page_size=page_size):
+        for record in page:
+            yield record
 
 
 # USER IDS
@@ -55,11 +581,10 @@ def _request_user_ids():
         'opt_fields': 'email,name'
         }
     endpoint = 'teams/{}/users/'.format(TEAM_ID)
-    url = 'https://app.asana.com/api/1.0/{}'.format(endpoint)
-    r = requests.get(url, params=params, auth=(TOKEN, ''))
-    user_ids = pd.DataFrame.from_records(r.json()['data'])[
-        ['email', 'gid', 'name']]. \
-        rename(columns={'gid': 'asana_id', 'name': 'asana_name'}). \
+    records = ((i.get('email'), i['gid'], i.get('name'))
+               for i in _iter_collection(endpoint, params))
+    user_ids = pd.DataFrame.from_records(
+        list(records), columns=['email', 'asana_id', 'asana_name']). \
         sort_values('asana_name').reset_index(drop=True)
 
     # user_ids['use_name'] = user_ids[]
@@ -71,14 +596,8 @@ def _request_user_ids():
     return user_ids
 
 
-def load_asana_ids():
-    global asana_ids
-    asana_ids = pd.read_feather(ids_local)
-
-
 def update_asana_ids():
     """Update info on all asana users: email, asana_id, asana_name."""
-    global asana_ids
     asana_ids = _request_user_ids()  # warns if email not recognized
 
     # CHECK FOR UNRECOGNIZED ASANA EMAILS
@@ -93,7 +612,17 @@ def update_asana_ids():
     else:
         logger.info("All asana ids are associated with names.")
     # asana_ids['task_list'] = asana_ids['asana_id'].map(user_task_list_dict)
-    asana_ids.to_feather(ids_local)
+    _publish(asana_ids=asana_ids)
+
+
+def _build_email_index(asana_ids):
+    """Get {email: asana_id} dictionary, keeping first id for repeated emails."""
+    if asana_ids is None:
+        return {}
+    email_index = {}
+    for email, asana_id in zip(asana_ids.email.values, asana_ids.asana_id.values):
+        email_index.setdefault(email, asana_id)
+    return email_index
 
 
 def get_asana_id_for_user(user):
@@ -104,21 +633,21 @@ def get_asana_id_for_user(user):
     """
     if user.asana_id:
         return user.asana_id
-    asana_matches = asana_ids[asana_ids.email.isin(user.known_emails)]
-    if not len(asana_matches):
+    email_index = snapshot.email_index
+    emails = [user.email] + sorted(user.known_emails.difference({user.email}))
+    matches = [email_index[i] for i in emails if i in email_index]
+    if not matches:
         logger.warning("No asana match for %s", user.display_name)
         return None
-    else:
-        if len(asana_matches) > 1:
-            logger.warning("%d asana matches for %s, using first match.",
-                           len(asana_matches), user.use_name)
-        asana_match = asana_matches.iloc[0]
-    asana_id = asana_match.asana_id
-    user.asana_id = asana_id
-    db.session.add(user)
-    db.session.commit()
-    # task_list = asana_match.task_list
-    return asana_id  # , task_list
+    if len(set(matches)) > 1:
+        logger.warning("%d asana matches for %s, using first match.",
+                       len(set(matches)), user.use_name)
+    asana_id = matches[0]
+    if user.asana_id != asana_id:
+        user.asana_id = asana_id
+        db.session.add(user)
+        db.session.commit()
+    return asana_id
 
 
 # PROJECTS
@@ -138,15 +667,13 @@ def _request_projects():
                   'team', 'workspace']
     params = {
         'opt_fields': ','.join(opt_fields),
-        'limit': 100,
         'archived': False
     }
     endpoint = 'teams/{}/projects'.format(TEAM_ID)
-    url = 'https://app.asana.com/api/1.0/{}'.format(endpoint)
     logger.info("Looking up all projects for team.")
-    r = requests.get(url, params=params, auth=(TOKEN, ''))
-    data = r.json()['data']
-    proj = pd.DataFrame.from_records(data, columns=opt_fields + ['gid'])
+    pages = [pd.DataFrame.from_records(data, columns=opt_fields + ['gid'])
+             for data in _iter_pages(endpoint, params)]
+    proj = pd.concat(pages, axis=0, ignore_index=True)
     proj.set_index('gid', inplace=True)
     proj.index.name = 'project_id'
     # SIMPLIFY DICTIONARY COLUMNS BY REDUCING TO (COMMA-SEPARATED) IDS
@@ -160,38 +687,42 @@ def _request_projects():
     return proj
 
 
-def load_projects():
-    global projects
-    temp = pd.read_feather(projects_local)
-    temp.set_index('project_id', inplace=True)
-    projects = temp
-
-
 def update_projects_listing():
-    global projects
-    projects = _request_projects()
-    temp = projects.reset_index()
-    temp.to_feather(projects_local)
+    _publish(projects=_request_projects())
 
 
 # TASKS
 
 def _request_project_tasks(project_id):
-    """Get incomplete tasks for project."""
-    keep_cols = ['name', 'due_on', 'modified_at', 'html_notes', 'assignee']
-    extra_cols = ['projects', 'memberships.(section|project).name']
+    """Get incomplete tasks for project.
 
-    opt_fields = keep_cols + extra_cols
+    Args:
+        project_id (str): Asana project gid.
+    """
+    keep_cols = TASK_KEEP_COLS
+    opt_fields = keep_cols + TASK_EXTRA_FIELDS
 
     params = {
         'opt_fields': ','.join(opt_fields),
         'completed_since': 'now'
     }
     endpoint = 'projects/{}/tasks'.format(project_id)
-    url = 'https://app.asana.com/api/1.0/{}'.format(endpoint)
-    r = requests.get(url, params=params, auth=(TOKEN, ''))
-    data = r.json()['data']
-    # item = pd.Series(r.json()['data'][0])
+    # PARSE ONE PAGE AT A TIME, KEEPING ONLY THE DERIVED FRAMES
+    all_tasks, all_parents = [], []
+    for data in _iter_pages(endpoint, params):
+        page_tasks, page_parents = _parse_tasks_page(data, keep_cols)
+        all_tasks.append(page_tasks)
+        all_parents.append(page_parents)
+    tasks = pd.concat(all_tasks, axis=0)
+    task_parents = pd.concat(all_parents, axis=0, ignore_index=True)
+    return tasks, task_parents
+
+
+def _parse_tasks_page(data, keep_cols):
+    """Build tasks and task_parents dataframes from a page of task records.
+
+    Derived columns are computed column-wise rather than per row.
+    """
     # GET TASKS TABLE
     use_cols = keep_cols + ['gid']
     tasks = pd.DataFrame(data, columns=use_cols)
@@ -199,32 +730,19 @@ def _request_project_tasks(project_id):
 
     tasks.set_index('gid', inplace=True)
     tasks.index.name = 'task_id'
-    tasks['html_notes'] = tasks.html_notes.apply(_remove_body_tags)
-    tasks['assignee'] = [i['gid'] if type(i) == dict else i
-                         for i in tasks['assignee'].values]
-    tasks['due_ts'] = tasks['due_on'].apply(
-        lambda v: pd.to_datetime(v, infer_datetime_format=True) if v else nat)
-    tasks['due_this_year'] = tasks['due_ts'].apply(
-        lambda v: v.date().year == dt.datetime.now().year)
-    tasks['overdue'] = tasks.due_ts.apply(lambda v: v.date() < dt.date.today())
-    tasks['url'] = ["https://app.asana.com/0/{workspace}/{task}"
-                    .format(task=v, workspace=app.config['ASANA_WORKSPACE_ID'])
-                    for v in tasks.index.values]
-
-    m_list = []
-    for task in data:
-        # parse memberships
-        memberships = task['memberships']
-        for m_dict in memberships:
-            proj = m_dict['project']
-            sec = m_dict['section']
-            m_dict = OrderedDict(task_id=task['gid'],
-                                 project_id=proj['gid'],
-                                 project_name=proj['name'],
-                                 section_id=sec['gid'] if sec else None,
-                                 section_name=sec['name'] if sec else None)
-            m_list.append(m_dict)
-    task_parents = pd.DataFrame.from_records(m_list)
+    tasks['html_notes'] = _remove_body_tags_vec(tasks.html_notes)
+    tasks['assignee'] = tasks.assignee.map(itemgetter('gid'), na_action='ignore')
+    tasks['due_ts'] = pd.to_datetime(tasks.due_on, format='%Y-%m-%d',
+                                     errors='coerce')
+    # due_this_year, overdue are added when read (see TaskIndex.get_tasks)
+    url_prefix = 'https://app.asana.com/0/{}/'.format(WORKSPACE_ID)
+    tasks['url'] = url_prefix + tasks.index.to_series()
+
+    # FLATTEN MEMBERSHIPS
+    m_list = [(task['gid'], m['project']['gid'], m['project']['name'],
+               (m['section'] or {}).get('gid'), (m['section'] or {}).get('name'))
+              for task in data for m in task['memberships']]
+    task_parents = pd.DataFrame.from_records(m_list, columns=LINK_COLS)
 
     # # GET TASK-PROJECT MAP TABLE
     # map_tuples = []
@@ -236,78 +754,437 @@ def _request_project_tasks(project_id):
     return tasks, task_parents
 
 
-def load_tasks_links():
-    global tasks, links
-    tasks = pd.read_feather(tasks_local)
-    links = pd.read_feather(links_local)
+def _request_project_listing(project_id):
+    """Get compact listing of incomplete tasks in project.
 
+    Only gid, modified_at and memberships are requested, so tasks in several
+    projects cost little to list in each of them.
 
-def update_tasks_links():
-    """Gather tasks for all projects, and linkage between task, section, project."""
-    global tasks, links
+    Returns:
+        modified (pd.Series): modified_at by task_id.
+        links (pd.DataFrame): task_parents table of memberships in project.
+    """
+    params = {
+        'opt_fields': ','.join(TASK_LIST_FIELDS),
+        'completed_since': 'now'
+    }
+    endpoint = 'projects/{}/tasks'.format(project_id)
+    modified = OrderedDict()
+    m_list = []
+    for task in _iter_collection(endpoint, params):
+        modified[task['gid']] = task['modified_at']
+        m_list.extend(
+            (task['gid'], m['project']['gid'], m['project']['name'],
+             (m['section'] or {}).get('gid'), (m['section'] or {}).get('name'))
+            for m in task['memberships']
+            if (m.get('project') or {}).get('gid') == project_id)
+    modified = pd.Series(list(modified.values()), index=list(modified.keys()),
+                         dtype=object)
+    links = pd.DataFrame.from_records(m_list, columns=LINK_COLS)
+    return modified, links
+
+
+def _request_project_listings(project_ids):
+    """Get {project_id: (modified, links)} listings using a bounded worker pool."""
+    project_ids = sorted(project_ids)
+    if not project_ids:
+        return {}
+    n_workers = min(MAX_WORKERS, len(project_ids))
+    logger.info("Listing tasks for %d projects (%d workers).",
+                len(project_ids), n_workers)
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        results = list(executor.map(_request_project_listing, project_ids))
+    return dict(zip(project_ids, results))
+
+
+def _request_listed_tasks(listings, current):
+    """Get tasks table for all listed tasks, with as few requests as possible.
+
+    Tasks with the same modified_at as in the current snapshot are reused
+    without their html_notes, which are added back from current notes when
+    published (see _split_notes). Other tasks are fetched with their
+    projects' task pages or by id, whichever costs fewer requests (see
+    _plan_task_fetches).
+
+    Args:
+        listings (dict): {project_id: (modified, links)}.
+        current (AsanaSnapshot): snapshot with tasks to reuse.
+    Returns:
+        pd.DataFrame of tasks, with task_id column.
+    """
+    modified = pd.concat([i[0] for i in listings.values()])
+    modified = modified[~modified.index.duplicated()]
+    n_listed = sum(len(i[0]) for i in listings.values())
+    reused = None
+    if current.tasks is not None:
+        current_tasks = current.tasks.astype({i: object for i in TASK_CATEG_COLS})
+        current_modified = current_tasks.set_index('task_id').modified_at
+        same = current_modified.reindex(modified.index).values == modified.values
+        reused = current_tasks[current_tasks.task_id.isin(modified.index[same])]
+    reused_ids = set() if reused is None else set(reused.task_id)
+    fetch_ids = [i for i in modified.index if i not in reused_ids]
+    page_projects, fetch_ids = _plan_task_fetches(listings, fetch_ids)
+    paged = []
+    if page_projects:
+        n_workers = min(MAX_WORKERS, len(page_projects))
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            paged = [i[0].reset_index() for i in
+                     executor.map(_request_project_tasks, page_projects)]
+    fetched, _ = _request_tasks_by_id(fetch_ids)
+    fetched = pd.concat(paged + [fetched.reset_index()], axis=0,
+                        ignore_index=True).drop_duplicates('task_id')
+    if reused is not None:
+        reused = reused[~reused.task_id.isin(fetched.task_id)]
+    logger.info("Listed %d tasks (%d unique): fetched %d (%d projects by page), "
+                "reused %d.", n_listed, len(modified), len(fetched),
+                len(page_projects), 0 if reused is None else len(reused))
+    return pd.concat([reused, fetched], axis=0, ignore_index=True)
+
+
+def _plan_task_fetches(listings, fetch_ids):
+    """Choose projects to fetch in full by page, and tasks to fetch by id.
+
+    Asana counts each batch action as a request, so fetching tasks by id
+    costs one request per task, while a project's task pages cost one per
+    PAGE_SIZE tasks. Projects are fetched by page where that takes fewer
+    requests, densest first, so cold and mass-change refreshes cost about as
+    much as listing, and sparse changes are fetched by id.
+
+    Args:
+        listings (dict): {project_id: (modified, links)}.
+        fetch_ids (list): ids of tasks to fetch.
+    Returns:
+        page_projects (list): ids of projects to fetch by page.
+        fetch_ids (list): ids of tasks to fetch by id.
+    """
+    remaining = set(fetch_ids)
+    n_pages = {k: max(1, -(-len(v[0]) // PAGE_SIZE)) for k, v in listings.items()}
 
-    all_tasks, all_parents = [], []
-    project_ids = set(projects.index)
-    for project_id in project_ids:
+    def density(project_id):
+        n_fetch = len(remaining.intersection(listings[project_id][0].index))
+        return n_fetch / n_pages[project_id]
+
+    page_projects = []
+    for project_id in sorted(listings, key=density, reverse=True):
+        task_ids = remaining.intersection(listings[project_id][0].index)
+        if len(task_ids) > n_pages[project_id]:
+            page_projects.append(project_id)
+            remaining.difference_update(task_ids)
+    return page_projects, [i for i in fetch_ids if i in remaining]
+
+
+def update_tasks_links(incremental=False):
+    """Gather tasks for all projects, and linkage between task, section, project.
+
+    Args:
+        incremental (bool): only fetch tasks changed since the last sync, if
+            sync state is available. Falls back to a full refresh otherwise.
+    """
+    with _tasks_lock:
+        if incremental:
+            current = snapshot
+            if current.sync_state is not None and current.tasks is not None:
+                _sync_tasks_links(current)
+                return
+            logger.info("No sync state available. Running full task refresh.")
+        _refresh_tasks_links()
+
+
+def _refresh_tasks_links():
+    """Fetch all tasks for all projects, replacing all project partitions.
+
+    Projects are listed compactly, then each task that is new or modified
+    since the current snapshot is downloaded once, however many projects it
+    belongs to. Links are built from the listed memberships of each project.
+    """
+    current = snapshot
+    project_ids = sorted(current.projects.index)
+    sync_tokens = _request_sync_tokens(project_ids)
+    listings = _request_project_listings(project_ids)
+    tasks = _request_listed_tasks(listings, current)
+    partitions = {project_id: _make_partition(project_id, tasks, links)
+                  for project_id, (_, links) in listings.items()}
+    _publish(partitions=partitions, sync_state={'tokens': sync_tokens})
+    client.log_stats()
+    log_memory_report()
+
+
+def update_project_tasks(project_id):
+    """Refetch all tasks for a single project, replacing only its partition.
+
+    The projects listing is refreshed first if the project is not known.
+    """
+    with _tasks_lock:
+        if project_id not in snapshot.projects.index:
+            update_projects_listing()
+            if project_id not in snapshot.projects.index:
+                logger.warning("Project %s not found. Skipping task update.",
+                               project_id)
+                return
+        _, sync_token = _request_project_events(project_id)
+        listings = _request_project_listings([project_id])
+        tasks = _request_listed_tasks(listings, snapshot)
+        partition = _make_partition(project_id, tasks, listings[project_id][1])
+        changes = {'partitions': {project_id: partition}}
+        state = snapshot.sync_state
+        if state is not None:
+            # events before the new token are covered by the refetch
+            changes['sync_state'] = {
+                'tokens': dict(state['tokens'], **{project_id: sync_token})}
+        _publish(**changes)
+    logger.info("Updated project %s (%d tasks).", project_id, len(partition[0]))
+
+
+# INCREMENTAL TASK SYNC
+
+ProjectSync = namedtuple('ProjectSync', ['project_id', 'sync_token', 'full',
+                                         'tasks', 'parents', 'touched_ids'])
+
+
+def _request_project_events(project_id, sync_token=None):
+    """Get events for project since sync token.
+
+    Returns:
+        events (list): event records, or None if the sync token was missing
+            or has expired (i.e. a full fetch of the project is needed).
+        sync_token (str): token to use for the next request.
+    """
+    params = {'resource': project_id}
+    events = []
+    while True:
+        if sync_token:
+            params['sync'] = sync_token
+        r = client.get('events', params=params)
+        if r.status_code == 412:  # missing or expired token, new one in body
+            return None, r.json()['sync']
+        r.raise_for_status()
+        body = r.json()
+        events.extend(body['data'])
+        sync_token = body['sync']
+        if not body.get('has_more'):
+            return events, sync_token
+
+
+def _request_sync_tokens(project_ids):
+    """Get dictionary of {project_id: sync_token} for current project states."""
+    project_ids = sorted(project_ids)
+    if not project_ids:
+        return {}
+    n_workers = min(MAX_WORKERS, len(project_ids))
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        results = list(executor.map(_request_project_events, project_ids))
+    return {p: token for p, (_, token) in zip(project_ids, results)}
+
+
+def _sync_project(project_id, sync_token):
+    """Get task changes for a single project since the last sync.
+
+    Returns:
+        ProjectSync. If full is True, tasks holds all incomplete tasks for the
+            project; otherwise it holds the incomplete tasks with events, and
+            touched_ids holds ids of all tasks with events (including
+            completed, deleted and removed tasks). tasks is None if unchanged.
+    """
+    events, new_token = _request_project_events(project_id, sync_token)
+    if events is None:
+        logger.info("No valid sync token for project %s. Fetching all tasks.",
+                    project_id)
         tasks, parents = _request_project_tasks(project_id)
-        all_tasks.append(tasks)
-        all_parents.append(parents)
-    links = pd.concat(all_parents, axis=0, ignore_index=True).drop_duplicates()
-
-    # HANDLE UNRECOGNIZED PROJECT REFERENCES
-    unknown_projects = set(links.project_id).difference(project_ids)
-    if unknown_projects:
-        # try lookup, drop if fails
-        update_projects_listing()
-        refreshed_proj_ids = set(projects.index)
-        still_unknown = set(links.project_id).difference(refreshed_proj_ids)
-        new_project_ids = refreshed_proj_ids.difference(project_ids)
-        if new_project_ids:
-            logger.info("Found new projects in links: %s", new_project_ids)
-            for project_id in new_project_ids:
-                tasks, parents = _request_project_tasks(project_id)
-                all_tasks.append(tasks)
-                all_parents.append(parents)
-        if still_unknown:
-            logger.info("Dropping unknown projects from links: %s",
-                        still_unknown)
-            links = links[~links.project_id.isin(still_unknown)] \
-                .reset_index(drop=True)
-
-    # Concatenate tasks and metadata, dropping duplicates (from redundant loading)
-    tasks = pd.concat(all_tasks, axis=0, ignore_index=False).drop_duplicates()
-    tasks = tasks.sort_values('due_on')
-    tasks.reset_index(inplace=True)
-
-    links = pd.concat(all_parents, axis=0, ignore_index=True).drop_duplicates()
-    links['section_id'] = links['section_id'].fillna('0')  # use '0' for blanks
-    links['section_name'] = links['section_name'].fillna('')
-    links.reset_index(drop=True, inplace=True)
+        return ProjectSync(project_id, new_token, True, tasks, parents, set())
+    resource_types = {e['resource']['resource_type'] for e in events}
+    if resource_types.intersection({'section', 'project'}):
+        # section or project names may have changed
+        tasks, parents = _request_project_tasks(project_id)
+        return ProjectSync(project_id, new_token, True, tasks, parents, set())
+    touched_ids = {e['resource']['gid'] for e in events
+                   if e['resource']['resource_type'] == 'task'}
+    if not touched_ids:
+        return ProjectSync(project_id, new_token, False, None, None, set())
+    tasks, parents = _request_tasks_by_id(touched_ids)
+    return ProjectSync(project_id, new_token, False, tasks, parents,
+                       touched_ids)
 
-    tasks.to_feather(tasks_local)
-    links.to_feather(links_local)
+
+def _sync_tasks_links(current):
+    """Update partitions of changed projects since last sync, using Asana events.
+
+    Args:
+        current (AsanaSnapshot): snapshot with sync_state to update from.
+    """
+    state = current.sync_state
+    old_tokens = state['tokens']
+    project_ids = sorted(current.projects.index)
+    n_workers = max(1, min(MAX_WORKERS, len(project_ids)))
+    logger.info("Syncing task changes for %d projects.", len(project_ids))
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        results = list(executor.map(_sync_project, project_ids,
+                                    [old_tokens.get(i) for i in project_ids]))
+
+    partitions = {}
+    changed = [i for i in results if i.tasks is not None]
+    for result in changed:
+        project_id = result.project_id
+        tasks = result.tasks.reset_index()
+        if result.full:
+            partitions[project_id] = _make_partition(project_id, tasks,
+                                                     result.parents)
+        else:
+            partitions[project_id] = _merge_partition(
+                _get_partition(current, project_id), project_id, tasks,
+                result.parents, result.touched_ids)
+    logger.info("Synced %d changed projects (%d full).", len(changed),
+                sum(i.full for i in changed))
+
+    sync_tokens = {i.project_id: i.sync_token for i in results}
+    _publish(partitions=partitions, sync_state={'tokens': sync_tokens})
+    client.log_stats()
+    log_memory_report()
+
+
+# UPDATES FOR SPECIFIC TASKS
+
+def _request_tasks_by_id(task_ids):
+    """Get tasks, task_parents for specified tasks that exist and are incomplete.
+
+    Tasks are requested via the batch API, BATCH_SIZE per request.
+    """
+    paths = ['/tasks/{}'.format(i) for i in sorted(task_ids)]
+    fields = TASK_KEEP_COLS + TASK_EXTRA_FIELDS + ['completed']
+    chunks = [paths[i:i + BATCH_SIZE] for i in range(0, len(paths), BATCH_SIZE)]
+    n_workers = max(1, min(MAX_WORKERS, len(chunks)))
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        results = list(executor.map(client.get_batch, chunks, repeat(fields)))
+    records = []
+    for path, (status, data) in zip(paths, (i for j in results for i in j)):
+        if status == 404:  # deleted
+            continue
+        if status != 200:
+            raise requests.HTTPError('Asana batch request for {} failed '
+                                     '({}).'.format(path, status))
+        if not data.get('completed'):
+            records.append(data)
+    return _parse_tasks_page(records, TASK_KEEP_COLS)
+
+
+def update_tasks_by_id(task_ids):
+    """Refetch specified tasks and merge them into the partitions they touch.
+
+    Tasks that have been deleted, completed or removed from all known
+    projects are dropped.
+    """
+    task_ids = set(task_ids)
+    if not task_ids:
+        return
+    fetched, parents = _request_tasks_by_id(task_ids)
+    with _tasks_lock:
+        current = snapshot
+        if current.tasks is None:
+            logger.warning("No tasks loaded. Skipping update of %d tasks.",
+                           len(task_ids))
+            return
+        touched = task_ids.union(fetched.index)
+        links = current.links
+        project_ids = set(links.project_id[links.task_id.isin(touched)]) \
+            .union(parents.project_id)
+        project_ids.intersection_update(current.projects.index)
+        fetched = fetched.reset_index()
+        partitions = {
+            project_id: _merge_partition(_get_partition(current, project_id),
+                                         project_id, fetched, parents, touched)
+            for project_id in project_ids}
+        _publish(partitions=partitions)
+    logger.info("Updated %d tasks (%d current) in %d projects.", len(task_ids),
+                len(fetched), len(partitions))
+
+
+# TASK INDEX
+
+class TaskIndex:
+    """Task row positions by assignee, grouped by project and section.
+
+    Built once per tasks snapshot, so that page views only gather the rows
+    they display. Unassigned tasks are listed under the UNASSIGNED key.
+    """
+    UNASSIGNED = 'unassigned'
+
+    def __init__(self, tasks, links):
+        self.tasks = tasks
+        self.links = links
+        assignees = tasks.assignee.astype(object)
+        assignees = assignees.where(assignees.notnull(), self.UNASSIGNED).values
+        positions = pd.Series(np.arange(len(tasks)), index=tasks.task_id.values)
+        positions = positions[~positions.index.duplicated()]
+        linked = links.assign(pos=links.task_id.map(positions))
+        linked = linked[linked.pos.notnull()]
+        linked['pos'] = linked['pos'].astype(int)
+        linked['assignee'] = assignees[linked.pos.values]
+
+        # {assignee: {(project_id, section_id): (project_name, section_name, positions)}}
+        self.sections = defaultdict(dict)
+        for (assignee, project_id, section_id), group in linked.groupby(
+                ['assignee', 'project_id', 'section_id'], observed=True):
+            self.sections[assignee][(project_id, section_id)] = (
+                group.project_name.iloc[0], group.section_name.iloc[0],
+                np.sort(group.pos.values))
+        # {assignee: positions}, in tasks (due date) order
+        self.assigned = {k: np.flatnonzero(assignees == k)
+                         for k in pd.unique(assignees)}
+        # {task_id: [(project_name, section_name), ...]}
+        self.locations = {
+            task_id: [tuple(i) for i in group[['project_name', 'section_name']].values]
+            for task_id, group in linked.groupby('task_id', observed=True)}
+
+    def get_tasks(self, positions):
+        """Get task rows at positions, with date flags evaluated for today.
+
+        Only the requested rows are copied, so no flagged copy of the full
+        table is kept.
+        """
+        return _add_date_flags(self.tasks.iloc[positions], dt.date.today())
+
+    def get_sections(self, asana_id, include_unassigned=True):
+        """Get {(project_id, section_id): (project_name, section_name, positions)}."""
+        keys = [asana_id, self.UNASSIGNED] if include_unassigned else [asana_id]
+        merged = {}
+        for key in keys:
+            for group_key, (proj_name, sec_name, pos) in \
+                    self.sections.get(key, {}).items():
+                if group_key in merged:
+                    pos = np.sort(np.concatenate([merged[group_key][2], pos]))
+                merged[group_key] = (proj_name, sec_name, pos)
+        return merged
+
+    def get_assigned(self, asana_id):
+        """Get positions of tasks assigned to asana_id, in due date order."""
+        return self.assigned.get(asana_id, np.array([], dtype=int))
+
+
+def _add_date_flags(tasks, today):
+    """Get copy of tasks with due_this_year, overdue columns for given date."""
+    today = pd.Timestamp(today)
+    return tasks.assign(due_this_year=tasks.due_ts.dt.year == today.year,
+                        overdue=tasks.due_ts < today)
+
+
+def _with_notes(tasks, notes):
+    """Add html_notes column for displayed task rows."""
+    if notes is None:
+        return tasks.assign(html_notes='')
+    return tasks.assign(html_notes=notes.get(tasks.task_id.values))
 
 
 def get_task_dict_for_user(asana_id: str, include_unassigned=True):
-    if include_unassigned:
-        show_bool = (tasks.assignee.isnull()) | (tasks.assignee == asana_id)
-    else:
-        show_bool = tasks.assignee == asana_id
-    show_tasks = tasks[show_bool].copy()
-    show_tasks['mine'] = (show_tasks.assignee == asana_id)
-    show_links = links[links.task_id.isin(show_tasks.task_id)]
-    # show_proj_ids = show_links.project_id.unique()
+    current = snapshot  # use single snapshot throughout
+    index = current.task_index
     show_dict = defaultdict(OrderedDict)
 
     # warning: could be an issue if section names are repeated within a project
-    for _, temp_tasks in show_links.groupby(['project_id', 'section_id']):
-        project_name = temp_tasks.project_name.iloc[0]
-        section_name = temp_tasks.section_name.iloc[0]
-        sec_tasks = show_tasks[show_tasks.task_id.isin(temp_tasks.task_id)]
+    sections = index.get_sections(asana_id, include_unassigned)
+    for group_key in sorted(sections):
+        project_name, section_name, pos = sections[group_key]
+        sec_tasks = _with_notes(index.get_tasks(pos), current.notes)
+        sec_tasks['mine'] = (sec_tasks.assignee == asana_id)
         show_dict[project_name][section_name] = sec_tasks
-    #     print('{}: {}'.format(project_name, section_name))
-    #     for i in sec_tasks['name']:
-    #         print('\t{}'.format(i))
     return show_dict
 
 
@@ -322,6 +1199,19 @@ def _remove_body_tags(html):
     return html
 
 
+def _remove_body_tags_vec(html):
+    """Vectorized _remove_body_tags for a series of html strings."""
+    front = '<body>'
+    back = '</body>'
+    html = html.fillna('')
+    wrapped = html.str.startswith(front)
+    unclosed = wrapped & ~html.str.endswith(back)
+    if unclosed.any():
+        raise Exception('Missing closing body tag in html: {}'.format(
+            html[unclosed].iloc[0]))
+    return html.where(~wrapped, html.str.slice(len(front), -len(back)))
+
+
 def load_user_assigned_tasks(user):
     """Get table of upcoming tasks assigned to db user.
 
@@ -333,23 +1223,20 @@ def load_user_assigned_tasks(user):
     if asana_id is None:
         return
 
-    my_tasks = tasks[tasks.assignee == asana_id].copy()
-    if not len(my_tasks):
+    current = snapshot  # use single snapshot throughout
+    index = current.task_index
+    pos = index.get_assigned(asana_id)
+    if not len(pos):
         return
-    my_links = links[links.task_id.isin(my_tasks.task_id)]
-    where_dict = {}
-    for task_id, group in my_links.groupby('task_id'):
-        where_dict[task_id] = [tuple(i) for i in
-                               group[['project_name', 'section_name']].values]
-    my_tasks['location'] = my_tasks.task_id.map(where_dict)
+    my_tasks = _with_notes(index.get_tasks(pos), current.notes)
+    my_tasks['location'] = [index.locations.get(i)
+                            for i in my_tasks.task_id.values]
     return my_tasks
 
 
 
 # GLOBALS: PROJECTS
-load_asana_ids()  # update asana_ids
-load_projects()  # update projects
-load_tasks_links()  # update tasks, links
+load_snapshot()  # asana_ids, projects, tasks, links
 
 
 class Unused:
@@ -370,8 +1257,7 @@ class Unused:
         #     'opt_fields': 'email,name'
         #     }
         # endpoint = 'teams/{}/users/'.format(TEAM_ID)
-        url = 'https://app.asana.com/api/1.0/{}'.format(endpoint)
-        r = requests.get(url, params=param_dict, auth=(TOKEN, ''))
+        r = client.get(endpoint, params=param_dict)
         return r
 
     @staticmethod
@@ -415,13 +1301,12 @@ class Unused:
         }
         # name_ids = [tuple(i) for i in asana_ids[['asana_name', 'asana_id']].values]
         user_list_dict = {}
-        user_ids = asana_ids['asana_id']
+        user_ids = snapshot.asana_ids['asana_id']
         logger.info('Fetching task list ids for %s users.', len(user_ids))
         for user_id in user_ids:  # for person_name, user_id in name_ids:
             # logger.info('Fetching list for %s', person_name)
             endpoint = 'users/{}/user_task_list'.format(user_id)
-            url = 'https://app.asana.com/api/1.0/{}'.format(endpoint)
-            r = requests.get(url, params=params, auth=(TOKEN, ''))
+            r = client.get(endpoint, params=params)
             """EXAMPLE RESPONSE
             {'data': {'id': 801620836635449,
              'gid': '801620836635449',
@@ -461,8 +1346,7 @@ class Unused:
             'completed_since': 'now'
         }
         endpoint = 'user_task_lists/{}/tasks'.format(user.task_list_id)
-        url = 'https://app.asana.com/api/1.0/{}'.format(endpoint)
-        r = requests.get(url, params=params, auth=(TOKEN, ''))
+        r = client.get(endpoint, params=params)
         data = r.json()['data']
         # item = pd.Series(r.json()['data'][0])
         # GET TASKS TABLE
@@ -0,0 +1,286 @@
+import os
+import hmac
+import json
+import uuid
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+
+import requests
+
+from . import app, DATA_DIR
+from .asana import (client, get_snapshot, update_tasks_by_id, WORKSPACE_ID,
+                    _iter_collection)
+
+
+logger = logging.getLogger(__name__)
+
+BATCH_SECONDS = app.config['ASANA_WEBHOOK_BATCH_SECONDS']
+WEBHOOK_PATH = '/asana/webhook/{}'
+
+# LOCAL FILE FOR STORING {project_id: webhook secret}
+secrets_local = os.path.join(DATA_DIR, 'asana_webhooks.json')
+
+
+class SecretStore:
+    """Webhook secrets by project id, saved to a json file if path is given.
+
+    Secrets are set by webhook handshakes, which are only accepted while a
+    webhook creation request for the project is pending (see
+    expect_handshake). A handshake for a new webhook replaces the project's
+    previous secret.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._secrets = {}
+        self._pending = set()  # project ids awaiting handshake
+        self._lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                self._secrets = json.load(f)
+
+    def __contains__(self, project_id):
+        return project_id in self._secrets
+
+    def get(self, project_id):
+        return self._secrets.get(project_id)
+
+    @contextmanager
+    def expect_handshake(self, project_id):
+        """Accept a webhook handshake for project while in this context."""
+        with self._lock:
+            self._pending.add(project_id)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._pending.discard(project_id)
+
+    def accept_handshake(self, project_id, secret):
+        """Store secret if a handshake is expected for project.
+
+        Returns:
+            bool: whether the handshake was accepted.
+        """
+        with self._lock:
+            if project_id not in self._pending:
+                return False
+            self._secrets[project_id] = secret
+            self._save()
+        return True
+
+    def _save(self):
+        if self.path is None:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self._secrets, f)
+        os.replace(tmp_path, self.path)
+
+
+secrets = SecretStore(secrets_local)
+
+
+def _sign(secret, body):
+    return hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+
+# EVENT HANDLING
+
+class EventBatcher:
+    """Collect webhook events and apply them in batches.
+
+    The first event of a burst starts a timer; all events received before it
+    fires are applied together. Batches are applied one at a time.
+    """
+
+    def __init__(self, apply, delay_seconds=BATCH_SECONDS):
+        self.apply = apply
+        self.delay_seconds = delay_seconds
+        self._pending = []
+        self._timer = None
+        self._lock = threading.Lock()
+        self._apply_lock = threading.Lock()
+
+    def add(self, events):
+        with self._lock:
+            self._pending.extend(events)
+            if self._timer is None:
+                self._timer = threading.Timer(self.delay_seconds, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        with self._apply_lock:
+            with self._lock:
+                events, self._pending = self._pending, []
+                self._timer = None
+            if not events:
+                return
+            try:
+                self.apply(events)
+            except Exception:
+                logger.exception("Failed to apply %d webhook events.",
+                                 len(events))
+
+
+def apply_events(events):
+    """Apply task create, update, delete and membership events.
+
+    Changed tasks are refetched and merged into the tasks snapshot. Section
+    or project changes (e.g. renames) trigger an update of the project, or
+    of the full task list if the project is not known.
+    """
+    task_ids = set()
+    project_ids = set()
+    structure_changed = False
+    for event in events:
+        resource = event.get('resource') or {}
+        resource_type = resource.get('resource_type')
+        if resource_type == 'task':
+            task_ids.add(resource['gid'])
+        elif resource_type == 'project':
+            project_ids.add(resource['gid'])
+        elif resource_type == 'section':
+            parent = event.get('parent') or {}
+            if parent.get('resource_type') == 'project':
+                project_ids.add(parent['gid'])
+            else:
+                structure_changed = True
+    logger.info("Applying %d webhook events (%d tasks).", len(events),
+                len(task_ids))
+    update_tasks_by_id(task_ids)
+    if project_ids or structure_changed:
+        from .scheduler import scheduler
+        if structure_changed:
+            scheduler.trigger('update_tasks')
+        else:
+            for project_id in sorted(project_ids):
+                scheduler.trigger('update_project', project_id)
+
+
+batcher = EventBatcher(apply_events)
+
+
+def handle_webhook(project_id, headers, body, store=None):
+    """Handle webhook handshake or event delivery for project.
+
+    Args:
+        project_id (str): project gid, from webhook target url.
+        headers: request headers.
+        body (bytes): raw request body.
+        store (SecretStore): webhook secrets. Defaults to module secrets.
+    Returns:
+        status (int): http status code.
+        response_headers (dict).
+    """
+    store = store or secrets
+    secret = headers.get('X-Hook-Secret')
+    if secret:  # handshake on webhook creation
+        if not store.accept_handshake(project_id, secret):
+            logger.warning("Rejected webhook handshake for project %s.",
+                           project_id)
+            return 403, {}
+        logger.info("Webhook handshake for project %s.", project_id)
+        return 200, {'X-Hook-Secret': secret}
+    expected = store.get(project_id)
+    signature = headers.get('X-Hook-Signature', '')
+    if expected is None or not hmac.compare_digest(_sign(expected, body),
+                                                   signature):
+        logger.warning("Rejected webhook request for project %s.", project_id)
+        return 401, {}
+    try:
+        events = json.loads(body.decode()).get('events', [])
+    except (ValueError, AttributeError):
+        logger.warning("Malformed webhook body for project %s.", project_id)
+        return 400, {}
+    if events:
+        batcher.add(events)
+    return 200, {}
+
+
+# WEBHOOK MANAGEMENT
+
+def _request_webhook_projects(target_prefix):
+    """Get ids of projects with an active webhook targeting this portal."""
+    params = {'workspace': WORKSPACE_ID, 'opt_fields': 'resource,target,active'}
+    return {i['resource']['gid'] for i in _iter_collection('webhooks', params)
+            if i.get('active') and i.get('target', '').startswith(target_prefix)}
+
+
+def register_webhooks(base_url=None):
+    """Create webhooks for team projects without an active one.
+
+    Existing webhooks are looked up in Asana, so webhooks that Asana has
+    deleted (e.g. after failed deliveries) are recreated, replacing their
+    stored secret. Asana performs the handshake against this app while the
+    request is in progress, so the portal must be reachable at base_url,
+    served by this process. Handshakes are only accepted while their creation
+    request is pending.
+
+    Args:
+        base_url (str): public url of portal. Defaults to APP_URL config.
+    """
+    base_url = (base_url or app.config['APP_URL']).rstrip('/')
+    active = _request_webhook_projects(base_url + WEBHOOK_PATH.format(''))
+    for project_id in get_snapshot().projects.index:
+        if project_id in active:
+            continue
+        data = {
+            'resource': project_id,
+            'target': base_url + WEBHOOK_PATH.format(project_id),
+            'filters': [{'resource_type': 'task'},
+                        {'resource_type': 'section'}],
+        }
+        with secrets.expect_handshake(project_id):
+            r = client.post('webhooks', json={'data': data})
+        if r.ok:
+            logger.info("Created webhook for project %s.", project_id)
+        else:
+            logger.warning("Webhook creation failed for project %s: %s",
+                           project_id, r.text)
+
+
+def replay_events(path, base_url=None):
+    """Stand-in for Asana: post recorded webhook payloads to the receiver.
+
+    Useful for offline and load testing. If base_url is None, payloads are
+    passed to handle_webhook in this process, with a separate in-memory
+    secret store: a handshake with a random secret is performed for each
+    project, and stored secrets of real webhooks are left untouched.
+    Otherwise payloads are signed with the stored secret for each project.
+
+    Args:
+        path (str): json lines file, with one payload per line as
+            {"project_id": ..., "events": [...]}.
+        base_url (str): portal url to post to.
+    Returns:
+        list of response status codes.
+    """
+    store = SecretStore() if base_url is None else secrets
+
+    def post(project_id, body, headers):
+        if base_url is None:
+            status, _ = handle_webhook(project_id, headers, body, store=store)
+            return status
+        url = base_url.rstrip('/') + WEBHOOK_PATH.format(project_id)
+        return requests.post(url, data=body, headers=headers).status_code
+
+    statuses = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            payload = json.loads(line)
+            project_id = payload['project_id']
+            if project_id not in store and base_url is None:
+                with store.expect_handshake(project_id):
+                    post(project_id, b'', {'X-Hook-Secret': uuid.uuid4().hex})
+            body = json.dumps({'events': payload['events']}).encode()
+            signature = _sign(store.get(project_id) or '', body)
+            statuses.append(post(project_id, body,
+                                 {'X-Hook-Signature': signature,
+                                  'Content-Type': 'application/json'}))
+    return statuses
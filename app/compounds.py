@@ -7,6 +7,7 @@ import numpy as np
 import pandas as pd
 from werkzeug.urls import url_quote_plus
 
+from . import app
 from .drive import file_tree_to_df
 from .decorators import asynch
 
@@ -63,12 +64,13 @@ SINGLE_COL_DICT = OrderedDict([
 
 COMPOUNDS = dict()
 
-# @TODO: set max depth. get path as list rather than string.
 
+def parse_path(path_dirs):
+    """Extract data attributes from directory names.
 
-def parse_path(path):
-    """Extract data attributes from directory names."""
-    path_dirs = path.split(' > ')
+    Args:
+        path_dirs (list): folder titles from root, as in path_parts column.
+    """
     is_top_dir = True if len(path_dirs) < 4 else False
     categ = path_dirs[1]
     p_name = path_dirs[2]
@@ -112,9 +114,13 @@ def load_prebuilt_listing():
     compounds_pickle = current_app.config['COMPOUNDS_PICKLE']
 
     df = pd.read_pickle(compounds_pickle)
+    if 'path_parts' in df:
+        path_parts = df.path_parts
+    else:  # listing saved by earlier versions
+        path_parts = df.path.str.split(' > ')
 
     categ, cas, compound, mass, date, is_top_dir = \
-        zip(*df.path.apply(parse_path).values)
+        zip(*path_parts.apply(parse_path).values)
     meta_a = pd.DataFrame({'categ': categ, 'cas': cas, 'compound': compound,
                            'mass': mass, 'date': date, 'is_top_dir': is_top_dir
                            })
@@ -161,14 +167,29 @@ def reload_listing():
     from flask import current_app
     compounds_dir = current_app.config['COMPOUNDS_DIR_ID']
     pickle_path = current_app.config['COMPOUNDS_PICKLE']
-    reload_listing_async(compounds_dir, pickle_path)
+    max_depth = current_app.config['COMPOUNDS_MAX_DEPTH']
+    reload_listing_async(compounds_dir, pickle_path, max_depth)
 
 
 @asynch
-def reload_listing_async(compounds_dir, pickle_path):
-    df = file_tree_to_df(compounds_dir, 'compounds')
-    df.to_pickle(pickle_path)
-    load_prebuilt_listing()
+def reload_listing_async(compounds_dir, pickle_path, max_depth=None):
+    """Save listing of compounds folder tree, then reload it.
+
+    Runs in a background thread, so failures are logged rather than raised.
+    A failed crawl resumes from its checkpoint on the next reload.
+
+    Args:
+        max_depth (int): deepest folder level to list, e.g. 2 for only the
+            files directly in compound folders (compounds > categ > compound).
+    """
+    try:
+        df = file_tree_to_df(compounds_dir, 'compounds', max_depth=max_depth)
+        df.to_pickle(pickle_path)
+        with app.app_context():
+            load_prebuilt_listing()
+    except Exception:
+        logger.exception('Failed to reload compounds listing.')
+        return
     logger.info('Saved new pickle file.')
 
 
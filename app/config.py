@@ -46,10 +46,32 @@ class Config(object):
 
     COMPOUNDS_DIR_ID = os.environ.get('COMPOUNDS_DIR_ID')
     COMPOUNDS_PICKLE = os.environ.get('COMPOUNDS_PICKLE')
+    # deepest folder level listed in compounds tree (0 for no limit)
+    COMPOUNDS_MAX_DEPTH = int(os.environ.get('COMPOUNDS_MAX_DEPTH', 0)) or None
+    # concurrent folder listings when crawling Drive folder trees
+    DRIVE_MAX_WORKERS = int(os.environ.get('DRIVE_MAX_WORKERS', 8))
+    # 'changes': stored drive listing, updated via Changes API;
+    # 'drive': list whole shared drive in one paged query; 'folders': per folder
+    DRIVE_CRAWL_ENGINE = os.environ.get('DRIVE_CRAWL_ENGINE', 'changes')
+    # bytes per request when downloading Drive files
+    DRIVE_CHUNK_SIZE = int(os.environ.get('DRIVE_CHUNK_SIZE', 1024 * 1024))
+    # disk budget for cached Drive file contents, in MB (0 to disable)
+    DRIVE_CACHE_MB = int(os.environ.get('DRIVE_CACHE_MB', 1024))
 
     ASANA_TOKEN = os.environ.get('ASANA_TOKEN', None)
     ASANA_WORKSPACE_ID = os.environ.get('ASANA_WORKSPACE_ID', None)
     ASANA_TEAM_ID = os.environ.get('ASANA_TEAM_ID', None)
+    # concurrent requests when fetching tasks for all projects
+    ASANA_MAX_WORKERS = int(os.environ.get('ASANA_MAX_WORKERS', 8))
+    ASANA_TIMEOUT = float(os.environ.get('ASANA_TIMEOUT', 30))  # seconds
+    ASANA_MAX_RETRIES = int(os.environ.get('ASANA_MAX_RETRIES', 5))
+    # delay for grouping bursts of webhook events into one update
+    ASANA_WEBHOOK_BATCH_SECONDS = float(
+        os.environ.get('ASANA_WEBHOOK_BATCH_SECONDS', 2))
+
+    # background refresh intervals, in minutes (0 to disable)
+    REFRESH_ALL_MINUTES = int(os.environ.get('REFRESH_ALL_MINUTES', 0))
+    REFRESH_TASKS_MINUTES = int(os.environ.get('REFRESH_TASKS_MINUTES', 15))
 
 
 class DevelopmentConfig(Config):
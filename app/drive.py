@@ -1,16 +1,47 @@
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
 import io
+import os
+import json
+import queue
+import random
 import logging
+import zipfile
+import tempfile
+import threading
+import time
 
+import httplib2
 import pandas as pd
-import networkx as nx
+from googleapiclient.errors import HttpError
 from googleapiclient.http import MediaIoBaseDownload
 
+from . import app, DATA_DIR
+from .file_cache import FileCache
 from .helpers import parse_timestamp_str
 
 
 logger = logging.getLogger(__name__)
 
+MAX_WORKERS = app.config['DRIVE_MAX_WORKERS']
+CRAWL_ENGINE = app.config['DRIVE_CRAWL_ENGINE']  # 'changes', 'drive' or 'folders'
+PAGE_SIZE = 1000  # maximum page size allowed by Drive files.list
+BATCH_SIZE = 100  # maximum calls per Drive batch request
+# reasons given by Drive for 403 responses that can be retried
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+MAX_RETRIES = 3  # retries for Drive calls failing with transient errors
+CHECKPOINT_SECONDS = 10  # minimum interval between crawl checkpoint saves
+CHECKPOINT_MAX_AGE = 6 * 3600  # seconds before crawl checkpoints are ignored
+DOWNLOAD_CHUNK_SIZE = app.config['DRIVE_CHUNK_SIZE']  # bytes per request
+TEAM_DRIVE_ID = '0AAiqq6S0lKYWUk9PVA'
+# local cache of downloaded file contents, keyed by modifiedTime
+CONTENT_CACHE = FileCache(os.path.join(DATA_DIR, 'drive_cache'),
+                          app.config['DRIVE_CACHE_MB'] * 1024 * 1024) \
+    if app.config['DRIVE_CACHE_MB'] else None
+FILE_FIELDS = ("kind,id,name,webViewLink,webContentLink,iconLink,thumbnailLink,"
+               "createdTime,modifiedTime,lastModifyingUser/displayName,mimeType,trashed")
+
 MIME_MAP = {
     'application/vnd.google-apps.spreadsheet':
         ('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', '.xlsx'),  # Google Sheets
@@ -19,13 +50,45 @@ MIME_MAP = {
 }
 
 
+class CrawlStats:
+    """Thread-safe counts of folders, pages and items listed in a crawl."""
+
+    def __init__(self):
+        self.folders = 0
+        self.pages = 0
+        self.items = 0
+        self._lock = threading.Lock()
+
+    def add_page(self, n_items):
+        with self._lock:
+            self.pages += 1
+            self.items += n_items
+
+    def add_folder(self):
+        with self._lock:
+            self.folders += 1
+
+    def __str__(self):
+        return '{} folders, {} pages, {} items'.format(self.folders, self.pages,
+                                                       self.items)
+
+
 class Folder:
-    def __init__(self, folder_id):
+    def __init__(self, folder_id, stats=None, files=None):
+        """Folder with child files and {id: title} of sub-folders.
+
+        Args:
+            folder_id (str): Drive folder id.
+            stats (CrawlStats): optional counter of pages and items listed.
+            files (pd.DataFrame): child files, as from get_child_files. Listed
+                via the Drive API if None.
+        """
         self.folder_id = folder_id
         self.files = []
         self.folders = OrderedDict()
 
-        files = get_child_files(folder_id)
+        if files is None:
+            files = get_child_files(folder_id, stats=stats)
         if len(files):
             for ind, file_info in files.query('~is_folder').iterrows():
                 self.files.append(file_info)
@@ -37,23 +100,193 @@ class Folder:
             logger.warning('Empty folder: {}'.format(folder_id))
 
 
-def get_child_files(folder_id):
-    """Get dataframe of files in specified folder."""
-    file_fields = ("files(kind,id,name,webViewLink,webContentLink,iconLink,thumbnailLink,createdTime,"
-                   "modifiedTime,lastModifyingUser/displayName,mimeType,trashed)")
+def iter_file_pages(stats=None, **list_kwargs):
+    """Yield pages (lists of file records) from a Drive files.list query.
+
+    Follows nextPageToken until the listing is exhausted.
+
+    Args:
+        stats (CrawlStats): optional counter of pages and items.
+        **list_kwargs: files.list arguments, e.g. q, fields. The fields
+            argument should include nextPageToken.
+    """
+    for page, _ in _iter_file_pages_from(None, stats=stats, **list_kwargs):
+        yield page
+
+
+def _iter_file_pages_from(page_token, stats=None, **list_kwargs):
+    """Yield (page, next page token) from page_token (None for first page).
+
+    The token is None for the last page.
+    """
+    from .admin import SERVICE_HANDLES, get_thread_http
+    collection = SERVICE_HANDLES['files'].files()
+    list_kwargs.setdefault('pageSize', PAGE_SIZE)
+    while True:
+        request = collection.list(pageToken=page_token, **list_kwargs)
+        res = _with_retries(request.execute, http=get_thread_http())
+        page = res.get('files', [])
+        if stats is not None:
+            stats.add_page(len(page))
+        page_token = res.get('nextPageToken')
+        yield page, page_token
+        if not page_token:
+            break
+
+
+def _child_files_kwargs(folder_id):
+    """Get files.list arguments for listing files in folder."""
+    return dict(q="{!r} in parents".format(folder_id),
+                corpora='teamDrive',
+                includeTeamDriveItems=True,
+                orderBy='modifiedTime desc',
+                supportsTeamDrives=True,
+                teamDriveId=TEAM_DRIVE_ID,
+                fields="nextPageToken,files({})".format(FILE_FIELDS))
+
+
+def get_child_files(folder_id, stats=None):
+    """Get dataframe of files in specified folder.
+
+    Args:
+        folder_id (str): Drive folder id.
+        stats (CrawlStats): optional counter of pages and items listed.
+    """
+    records = []
+    n_pages = 0
+    for page in iter_file_pages(stats=stats, **_child_files_kwargs(folder_id)):
+        records.extend(page)
+        n_pages += 1
+    if n_pages > 1:
+        logger.info('Read %d pages (%d items) for folder %s.', n_pages,
+                    len(records), folder_id)
+    if stats is not None:
+        stats.add_folder()
+    return _records_to_df(records)
 
+
+# BATCHED REQUESTS
+
+def _is_retryable(error):
+    """Check whether HttpError is a rate limit or server error."""
+    status = error.resp.status
+    if status in (429, 500, 502, 503, 504):
+        return True
+    if status != 403:
+        return False
+    try:
+        errors = json.loads(error.content.decode())['error'].get('errors', [])
+        return any(i.get('reason') in RATE_LIMIT_REASONS for i in errors)
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return False
+
+
+def _with_retries(func, *args, max_retries=MAX_RETRIES, **kwargs):
+    """Call func, retrying with backoff on rate limit, server or network errors.
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            return func(*args, **kwargs)
+        except (HttpError, OSError, httplib2.HttpLib2Error) as e:
+            if attempt == max_retries or \
+                    (isinstance(e, HttpError) and not _is_retryable(e)):
+                raise
+            delay = 2 ** attempt + random.random()
+            logger.warning('Drive call failed (%s). Retrying in %.1fs.', e,
+                           delay)
+            time.sleep(delay)
+
+
+def execute_batch(requests, max_retries=MAX_RETRIES):
+    """Execute Drive API requests, BATCH_SIZE per http round trip.
+
+    Calls that fail with rate limit or server errors are retried in a later
+    batch, and failed batch requests are resent, with backoff. Safe to use
+    from worker threads.
+
+    Args:
+        requests (list): HttpRequest objects built from SERVICE_HANDLES['files'],
+            e.g. files().get(...), not yet executed.
+        max_retries (int): retries per call.
+    Returns:
+        list of responses, or HttpError for calls that failed, in order of
+            requests.
+    """
+    from .admin import SERVICE_HANDLES, get_thread_http
+    results = [None] * len(requests)
+    pending = list(range(len(requests)))
+    for attempt in range(max_retries + 1):
+        if attempt:
+            time.sleep(2 ** attempt)
+        failed = []
+
+        def callback(request_id, response, exception):
+            ind = int(request_id)
+            results[ind] = response if exception is None else exception
+            if exception is not None and attempt < max_retries and \
+                    isinstance(exception, HttpError) and \
+                    _is_retryable(exception):
+                failed.append(ind)
+
+        for i in range(0, len(pending), BATCH_SIZE):
+            batch = SERVICE_HANDLES['files'].new_batch_http_request(
+                callback=callback)
+            for ind in pending[i:i + BATCH_SIZE]:
+                batch.add(requests[ind], request_id=str(ind))
+            _with_retries(batch.execute, http=get_thread_http())
+        if not failed:
+            break
+        logger.warning('Retrying %d of %d batched calls.', len(failed),
+                       len(pending))
+        pending = sorted(failed)
+    return results
+
+
+def _raise_errors(results):
+    for res in results:
+        if isinstance(res, Exception):
+            raise res
+
+
+def list_child_records(folder_ids, stats=None):
+    """Get {folder_id: [file records]} for folders, with batched requests.
+
+    The first page of every folder is requested in batches of BATCH_SIZE
+    calls, as are further pages for large folders, so listing N folders
+    costs about N / BATCH_SIZE round trips instead of N.
+
+    Args:
+        folder_ids (list): Drive folder ids.
+        stats (CrawlStats): optional counter of pages and items listed.
+    """
     from .admin import SERVICE_HANDLES
     collection = SERVICE_HANDLES['files'].files()
-    res = collection.list(q="{!r} in parents".format(folder_id),
-                          corpora='teamDrive',
-                          includeTeamDriveItems=True,
-                          orderBy='modifiedTime desc',
-                          pageSize=100,
-                          supportsTeamDrives=True,
-                          teamDriveId='0AAiqq6S0lKYWUk9PVA',
-                          fields=file_fields).execute()
-
-    files = pd.DataFrame.from_records(res['files'])  # type: pd.DataFrame
+    records = OrderedDict((i, []) for i in folder_ids)
+    page_tokens = OrderedDict((i, None) for i in records)
+    while page_tokens:
+        folder_ids = list(page_tokens)
+        results = execute_batch([
+            collection.list(pageToken=page_tokens[i], pageSize=PAGE_SIZE,
+                            **_child_files_kwargs(i))
+            for i in folder_ids])
+        _raise_errors(results)
+        page_tokens = OrderedDict()
+        for folder_id, res in zip(folder_ids, results):
+            page = res.get('files', [])
+            records[folder_id].extend(page)
+            if stats is not None:
+                stats.add_page(len(page))
+            if res.get('nextPageToken'):
+                page_tokens[folder_id] = res['nextPageToken']
+    if stats is not None:
+        for _ in records:
+            stats.add_folder()
+    return records
+
+
+def _records_to_df(records):
+    """Get dataframe of files from Drive file records, without trashed files."""
+    files = pd.DataFrame.from_records(records)  # type: pd.DataFrame
     if len(files):
         files.lastModifyingUser = files.lastModifyingUser.apply(lambda v: v['displayName'])
         files.createdTime = files.createdTime.apply(parse_timestamp_str)
@@ -78,85 +311,618 @@ def get_child_files(folder_id):
     return files
 
 
-def extract_folders(root_folder_id):
-    """Traverse directories to populate all folder objects given a root folder."""
-    # via https://stackoverflow.com/questions/28584470/iterating-over-a-growing-set-in-python
+class CrawlCheckpoint:
+    """Listings of an unfinished crawl, saved in DATA_DIR.
+
+    Folder crawls list folders top-down from the root, so replaying a crawl
+    with the saved {folder_id: records} listings recovers its frontier:
+    listed folders are not requested again, and listing continues where the
+    failed crawl stopped. Paged listings (see list_drive_records) instead
+    save {file_id: record} with the page_token of the next page, and meta
+    for values that must match the listing (e.g. a changes start token).
+
+    Listings are saved at most every CHECKPOINT_SECONDS, and when a crawl
+    fails. Checkpoints older than max_age seconds are ignored.
+    """
+
+    def __init__(self, name, max_age=CHECKPOINT_MAX_AGE):
+        self.path = os.path.join(DATA_DIR, 'drive_crawl_{}.json'.format(name))
+        self.created = time.time()
+        self.records = {}
+        self.page_token = None
+        self.meta = {}
+        self._saved = self.created
+        self._lock = threading.Lock()
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                state = json.load(f)
+            if self.created - state['created'] < max_age:
+                self.created = state['created']
+                self.records = state['records']
+                self.page_token = state.get('page_token')
+                self.meta = state.get('meta', {})
+                logger.info('Resuming crawl %s from checkpoint (%d listings).',
+                            name, len(self.records))
+
+    def get(self, keys):
+        """Get {key: records} for listed keys (e.g. folder ids) in keys."""
+        with self._lock:
+            return {i: self.records[i] for i in keys if i in self.records}
+
+    def add(self, records, page_token=None):
+        """Add listed records, and page token for next page, saving if due."""
+        with self._lock:
+            self.records.update(records)
+            self.page_token = page_token
+            if time.time() - self._saved >= CHECKPOINT_SECONDS:
+                self._save()
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def clear(self):
+        """Remove checkpoint file, e.g. when crawl has finished."""
+        with self._lock:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def _save(self):
+        fd, tmp_path = tempfile.mkstemp(prefix='.tmp-', dir=DATA_DIR)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'created': self.created, 'records': self.records,
+                       'page_token': self.page_token, 'meta': self.meta}, f)
+        os.replace(tmp_path, self.path)
+        self._saved = time.time()
+
+
+def extract_folders(root_folder_id, max_workers=MAX_WORKERS, resume=True,
+                    **crawl_options):
+    """Traverse directories to populate all folder objects given a root folder.
+
+    Folders are listed level by level. Each level is split into batches of
+    up to BATCH_SIZE folders, listed with one batched request per page (see
+    list_child_records), and batches are listed concurrently by a bounded
+    pool of workers. Transient errors are retried per call, with backoff.
+
+    Args:
+        root_folder_id (str): Drive folder id.
+        max_workers (int): concurrent batch listings.
+        resume (bool): checkpoint listings as they arrive, and resume from
+            the checkpoint of a failed crawl (see CrawlCheckpoint).
+        **crawl_options: max_depth, include, exclude, on_level (see _crawl).
+    Returns:
+        folder_dict (dict): {id: Folder}, with root folder as 'root'.
+        title_dict (dict): {id: title} for folder ids.
+    """
+    stats = CrawlStats()
+    checkpoint = CrawlCheckpoint(root_folder_id) if resume else None
+
+    def list_batch(folder_ids):
+        records = checkpoint.get(folder_ids) if checkpoint else {}
+        missing = [i for i in folder_ids if i not in records]
+        if missing:
+            listed = list_child_records(missing, stats=stats)
+            if checkpoint:
+                checkpoint.add(listed)
+            records.update(listed)
+        return [Folder(i, files=_records_to_df(records[i])) for i in folder_ids]
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            def list_level(folder_ids):
+                if len(folder_ids) > 1:
+                    logger.info('Listing %d folders.', len(folder_ids))
+                batches = [folder_ids[i:i + BATCH_SIZE]
+                           for i in range(0, len(folder_ids), BATCH_SIZE)]
+                return [folder for folders in executor.map(list_batch, batches)
+                        for folder in folders]
+            folder_dict, title_dict = _crawl(root_folder_id, list_level,
+                                             **crawl_options)
+    except Exception:
+        if checkpoint:
+            checkpoint.save()
+            logger.warning('Crawl of %s failed. Saved checkpoint with %d '
+                           'listed folders.', root_folder_id,
+                           len(checkpoint.records))
+        raise
+    if checkpoint:
+        checkpoint.clear()
+    logger.info('Crawled folder %s: %s.', root_folder_id, stats)
+    return folder_dict, title_dict
+
+
+def _crawl(root_folder_id, list_level, max_depth=None, include=None,
+           exclude=None, on_level=None):
+    """Breadth-first traversal of folder tree, one level at a time.
+
+    Args:
+        root_folder_id (str): Drive folder id.
+        list_level (callable): get Folder objects for a list of folder ids.
+        max_depth (int): deepest level of folders to list, with the root
+            folder at depth 0. None for no limit.
+        include (list): folder title patterns (fnmatch-style, e.g. '*_2019*').
+            If given, only matching folders below root are listed.
+        exclude (list): folder title patterns for folders not to list.
+        on_level (callable): called as on_level(depth, {id: Folder}) when a
+            level has been listed. May return ids of folders whose
+            sub-folders should not be listed.
+    Returns:
+        folder_dict (dict): {id: Folder}, with root folder as 'root'.
+        title_dict (dict): {id: title} for folder ids.
+    """
     folder_dict = {}  # will hold {id: Folder}
-    title_dict = {}  # will hold titles for folder ids
+    title_dict = {'root': 'root'}  # will hold titles for folder ids
 
-    root = Folder(root_folder_id)
+    root, = list_level([root_folder_id])
     folder_dict['root'] = root
-    title_dict['root'] = 'root'
-    for i, title in root.folders.items():
-        title_dict[i] = title
+    seen_ids = set()  # sub-folder ids
+    level = OrderedDict([('root', root)])
+    depth = 0
+    while level:
+        pruned_ids = set(on_level(depth, level) or ()) if on_level else set()
+        if max_depth is not None and depth >= max_depth:
+            break
+        next_ids = []
+        for folder_id, folder in level.items():
+            for sub_id, title in folder.folders.items():
+                title_dict[sub_id] = title
+                if sub_id in seen_ids or folder_id in pruned_ids \
+                        or not _match_title(title, include, exclude):
+                    continue
+                seen_ids.add(sub_id)
+                next_ids.append(sub_id)
+        depth += 1
+        next_ids.sort()
+        level = OrderedDict(zip(next_ids, list_level(next_ids)))
+        folder_dict.update(level)
+    return folder_dict, title_dict
 
-    seen_ids = set(root.folders)  # sub-folder ids
-    active_ids = set(root.folders)
 
-    i = 0
-    while active_ids:
-        i += 1
-        next_active = set()
-        for subfolder_id in active_ids:
-            subfolder = Folder(subfolder_id)
-            folder_dict[subfolder_id] = subfolder
-            for new_sub_id in subfolder.folders:
-                title_dict[new_sub_id] = subfolder.folders[new_sub_id]
-                if new_sub_id not in seen_ids:
-                    seen_ids.add(new_sub_id)
-                    next_active.add(new_sub_id)
-        active_ids = next_active
+def _match_title(title, include=None, exclude=None):
+    """Check folder title against include and exclude patterns."""
+    if include and not any(fnmatch(title, i) for i in include):
+        return False
+    if exclude and any(fnmatch(title, i) for i in exclude):
+        return False
+    return True
+
+
+def list_drive_records(drive_id=TEAM_DRIVE_ID, resume=True):
+    """Get {file_id: record} for all files in shared drive, with parents.
+
+    Every file is listed once, so this costs one files.list call per page of
+    PAGE_SIZE files rather than one per folder.
+
+    Args:
+        drive_id (str): shared drive id.
+        resume (bool): checkpoint pages as they arrive, and resume a failed
+            listing from its next page (see CrawlCheckpoint).
+    """
+    checkpoint = CrawlCheckpoint('listing-' + drive_id) if resume else None
+    return _list_drive_records(drive_id, checkpoint)
+
+
+def _list_drive_records(drive_id, checkpoint=None):
+    """List drive as for list_drive_records, resuming from checkpoint.
+
+    The checkpoint is cleared once the listing is complete.
+    """
+    stats = CrawlStats()
+    records = {}
+    page_token = None
+    if checkpoint is not None and checkpoint.page_token:
+        records.update(checkpoint.records)
+        page_token = checkpoint.page_token
+    pages = _iter_file_pages_from(
+        page_token, stats=stats,
+        q='trashed = false',
+        corpora='teamDrive',
+        includeTeamDriveItems=True,
+        supportsTeamDrives=True,
+        teamDriveId=drive_id,
+        fields='nextPageToken,files({},parents)'.format(FILE_FIELDS))
+    try:
+        for page, page_token in pages:
+            page_records = {i['id']: i for i in page}
+            records.update(page_records)
+            if checkpoint is not None:
+                checkpoint.add(page_records, page_token)
+    except Exception:
+        if checkpoint is not None:
+            checkpoint.save()
+            logger.warning('Listing of drive %s failed. Saved checkpoint with '
+                           '%d files.', drive_id, len(checkpoint.records))
+        raise
+    if checkpoint is not None:
+        checkpoint.clear()
+    logger.info('Listed drive %s: %s.', drive_id, stats)
+    return records
+
+
+def extract_folders_from_records(records, root_folder_id, **crawl_options):
+    """Rebuild folder objects under root folder from file records with parents.
+
+    Args:
+        records (iterable): Drive file records, including parents field.
+        root_folder_id (str): Drive folder id.
+        **crawl_options: max_depth, include, exclude, on_level (see _crawl).
+    Returns:
+        folder_dict, title_dict: as for extract_folders.
+    """
+    children = defaultdict(list)  # {parent_id: [file records]}
+    for record in records:
+        for parent_id in record.get('parents', []):
+            children[parent_id].append(record)
+
+    def list_folder(folder_id):
+        # same order as folder listings in get_child_files
+        folder_records = sorted(children.get(folder_id, []),
+                                key=lambda v: v['modifiedTime'], reverse=True)
+        return Folder(folder_id, files=_records_to_df(folder_records))
+
+    folder_dict, title_dict = _crawl(root_folder_id,
+                                     lambda ids: [list_folder(i) for i in ids],
+                                     **crawl_options)
+    logger.info('Found %d folders under %s.', len(folder_dict), root_folder_id)
     return folder_dict, title_dict
 
 
-def file_tree_to_df(root_folder_id, root_title=None):
-    """Build dataframe containing all files in directory tree."""
+# INCREMENTAL CRAWL
+
+_changes_lock = threading.Lock()
+
+
+def _changes_state_path(drive_id):
+    return os.path.join(DATA_DIR, 'drive_changes_{}.json'.format(drive_id))
+
+
+def _load_changes_state(drive_id):
+    """Get stored {'token': str, 'records': {file_id: record}}, or None."""
+    path = _changes_state_path(drive_id)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def _save_changes_state(drive_id, state):
+    path = _changes_state_path(drive_id)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+def _request_start_page_token(drive_id):
+    from .admin import SERVICE_HANDLES, get_thread_http
+    res = SERVICE_HANDLES['files'].changes().getStartPageToken(
+        supportsTeamDrives=True, teamDriveId=drive_id
+    ).execute(http=get_thread_http())
+    return res['startPageToken']
+
+
+def _apply_changes(records, drive_id, page_token):
+    """Apply changes since page_token to {file_id: record} in place.
+
+    Added, moved and renamed files replace their records; removed and trashed
+    files are dropped.
+
+    Returns:
+        new_token (str): start page token for the next sync.
+        n_changes (int): number of changes applied.
+    Raises:
+        HttpError: if page_token is invalid or has expired.
+    """
+    from .admin import SERVICE_HANDLES, get_thread_http
+    collection = SERVICE_HANDLES['files'].changes()
+    fields = ('nextPageToken,newStartPageToken,'
+              'changes(fileId,removed,file({},parents))'.format(FILE_FIELDS))
+    n_changes = 0
+    while True:
+        res = collection.list(pageToken=page_token,
+                              pageSize=PAGE_SIZE,
+                              includeTeamDriveItems=True,
+                              supportsTeamDrives=True,
+                              teamDriveId=drive_id,
+                              fields=fields).execute(http=get_thread_http())
+        for change in res.get('changes', []):
+            file_id = change.get('fileId')
+            if file_id is None:  # change to drive itself
+                continue
+            n_changes += 1
+            record = change.get('file')
+            if change.get('removed') or record is None or record.get('trashed'):
+                records.pop(file_id, None)
+            else:
+                records[file_id] = record
+        if 'newStartPageToken' in res:
+            return res['newStartPageToken'], n_changes
+        page_token = res['nextPageToken']
+
+
+def sync_drive_records(drive_id=TEAM_DRIVE_ID):
+    """Get {file_id: record} for all files in drive, updated via Changes API.
+
+    Records and the changes start page token are stored in DATA_DIR, so a
+    sync only fetches changes since the last one. The drive is listed in
+    full on first use, or if the stored token is no longer valid.
+    """
+    with _changes_lock:
+        state = _load_changes_state(drive_id)
+        if state is not None:
+            records = state['records']
+            try:
+                token, n_changes = _with_retries(_apply_changes, records,
+                                                 drive_id, state['token'])
+            except HttpError as e:
+                if e.resp.status not in (400, 404, 410):
+                    raise
+                logger.warning('Invalid changes token for drive %s (%s). '
+                               'Listing all files.', drive_id, e.resp.status)
+                state = None
+            else:
+                logger.info('Applied %d changes for drive %s.', n_changes,
+                            drive_id)
+                if n_changes or token != state['token']:
+                    _save_changes_state(drive_id,
+                                        {'token': token, 'records': records})
+        if state is None:
+            # get token first, so that changes made while listing are not
+            # missed; a resumed listing keeps the token of its first attempt
+            checkpoint = CrawlCheckpoint('changes-' + drive_id)
+            token = checkpoint.meta.get('start_token') \
+                if checkpoint.page_token else None
+            if token is None:
+                token = _with_retries(_request_start_page_token, drive_id)
+                checkpoint.meta['start_token'] = token
+            records = _list_drive_records(drive_id, checkpoint)
+            _save_changes_state(drive_id, {'token': token, 'records': records})
+        return records
+
+
+def file_tree_to_df(root_folder_id, root_title=None, engine=None,
+                    **crawl_options):
+    """Build dataframe containing all files in directory tree.
+
+    Each file's folder is given as a ' > '-joined path string and as a
+    path_parts list of folder titles, starting with root_title.
+
+    Args:
+        root_folder_id (str): Drive folder id.
+        root_title (str): title to use for root in paths.
+        engine (str): 'changes' to use stored drive listing, updated with
+            changes since the last crawl (see sync_drive_records), 'drive' to
+            list the whole shared drive at once (see list_drive_records) or
+            'folders' to list folder by folder (see extract_folders). Defaults
+            to DRIVE_CRAWL_ENGINE config.
+        **crawl_options: max_depth, include, exclude, on_level, to limit the
+            folders listed (see _crawl).
+    """
     # GET FOLDER OBJECTS
-    folder_dict, title_dict = extract_folders(root_folder_id)
+    engine = engine or CRAWL_ENGINE
+    if engine == 'changes':
+        folder_dict, title_dict = extract_folders_from_records(
+            sync_drive_records().values(), root_folder_id, **crawl_options)
+    elif engine == 'drive':
+        folder_dict, title_dict = extract_folders_from_records(
+            list_drive_records().values(), root_folder_id, **crawl_options)
+    elif engine == 'folders':
+        folder_dict, title_dict = extract_folders(root_folder_id,
+                                                  **crawl_options)
+    else:
+        raise ValueError('Unknown crawl engine: {}'.format(engine))
     if root_title is None:
         root_title = 'ROOT'
     title_dict['root'] = root_title
 
-    # BUILD GRAPH FROM FOLDER > SUB-FOLDER RELATIONSHIPS
-    edges = []
-    for this_id in folder_dict:
-        new_edges = [(this_id, key) for key in folder_dict[this_id].folders]
-        edges.extend(new_edges)
-    graph = nx.DiGraph()
-    graph.add_edges_from(edges)
-
     # BUILD DATAFRAME
+    folder_paths = get_folder_paths(folder_dict, title_dict)
     df_list = []
     for folder_id in folder_dict:
-        node_ids = nx.algorithms.shortest_paths.generic.shortest_path(graph, 'root', folder_id)
-        node_titles = [title_dict[i] for i in node_ids]
+        node_titles = folder_paths[folder_id]
         node_path_str = ' > '.join(node_titles)
         files = folder_dict[folder_id].files
         if files:
             df = pd.DataFrame.from_records(files)
             df.insert(0, 'path', node_path_str)
+            df.insert(1, 'path_parts', [node_titles] * len(df))
             df_list.append(df)
     df = pd.concat(df_list, axis=0, ignore_index=True, sort=True)
-    df = df[['path'] + [i for i in df.columns if i != 'path']]
+    path_cols = ['path', 'path_parts']
+    df = df[path_cols + [i for i in df.columns if i not in path_cols]]
     return df
 
 
+def get_folder_paths(folder_dict, title_dict):
+    """Get {folder_id: [titles from root to folder]} in one top-down pass.
+
+    Folders are visited breadth-first from 'root', and each folder extends
+    its parent's path, so every ancestor chain is computed once. As with a
+    shortest path search, a folder reachable by several routes takes the
+    shortest.
+    """
+    paths = {'root': [title_dict['root']]}
+    active_ids = ['root']
+    while active_ids:
+        next_active = []
+        for folder_id in active_ids:
+            parent_path = paths[folder_id]
+            for sub_id in folder_dict[folder_id].folders:
+                if sub_id not in paths and sub_id in folder_dict:
+                    paths[sub_id] = parent_path + [title_dict[sub_id]]
+                    next_active.append(sub_id)
+        active_ids = next_active
+    return paths
+
+
+def get_file_metadata(file_id):
+    """Get dict of id, name, mimeType, modifiedTime and size for Drive file.
+
+    size is missing for Google formats (e.g. Docs), which are exported.
+    """
+    from .admin import SERVICE_HANDLES, get_thread_http
+    return SERVICE_HANDLES['files'].files().get(
+        fileId=file_id, supportsTeamDrives=True,
+        fields='id,name,mimeType,modifiedTime,size'
+    ).execute(http=get_thread_http())
+
+
+def _request_modified_times(file_ids):
+    """Get current Drive modifiedTime strings for files, in batched calls.
+
+    Returns:
+        list of modifiedTime, or None for files whose metadata request
+            failed, in order of file_ids.
+    """
+    from .admin import SERVICE_HANDLES
+    collection = SERVICE_HANDLES['files'].files()
+    results = execute_batch([
+        collection.get(fileId=i, supportsTeamDrives=True, fields='modifiedTime')
+        for i in file_ids])
+    return [None if isinstance(res, HttpError) else res.get('modifiedTime')
+            for res in results]
+
+
 def download_raw_file(file_id):
     """Get binary data for file."""
-    from .admin import SERVICE_HANDLES
-    request = SERVICE_HANDLES['files'].files().get_media(fileId=file_id)
     fh = io.BytesIO()
-    downloader = MediaIoBaseDownload(fh, request)
-    done = False
-    while done is False:
-        status, done = downloader.next_chunk()
-        # print("Download %d%%." % int(status.progress() * 100))
+    for chunk in iter_file_chunks(file_id, None):
+        fh.write(chunk)
     return fh
 
 
+def get_export_format(title, mime_orig):
+    """Get output filename and mime type for Drive file.
+
+    Returns:
+        filename (str): title, with extension added for exported formats.
+        mime_out (str): output mime type.
+        export (bool): whether file is exported (converted) on download.
+    """
+    if mime_orig in MIME_MAP:
+        mime_out, extension = MIME_MAP[mime_orig]
+        return ''.join([title, extension]), mime_out, True
+    return title, mime_orig, False
+
+
+def iter_file_chunks(file_id, mime_orig, chunk_size=DOWNLOAD_CHUNK_SIZE,
+                     start=0, end=None, version=None):
+    """Yield file contents as bytes chunks as Drive returns them.
+
+    Direct downloads are fetched with one Range request per chunk, starting
+    at byte start, so at most one chunk is held in memory. Exported formats
+    (see MIME_MAP) are converted by Drive and can't be ranged, so start and
+    end are ignored for them. Safe to use from worker threads.
+
+    If version is given, contents are served from and stored in the local
+    content cache (CONTENT_CACHE). Cached entries can be ranged whatever the
+    format.
+
+    Args:
+        file_id (str): Drive file id.
+        mime_orig (str): Mime type of Drive file.
+        chunk_size (int): bytes per request.
+        start (int): first byte to fetch.
+        end (int): last byte to fetch (inclusive), or None for end of file.
+        version: Drive modifiedTime of file, as string or parsed timestamp,
+            for caching.
+    """
+    version = _cache_version(version)
+    if version is None or CONTENT_CACHE is None:
+        yield from _iter_drive_chunks(file_id, mime_orig, chunk_size,
+                                      start, end)
+        return
+    _, mime_out, _ = get_export_format('', mime_orig)
+    f = CONTENT_CACHE.open(file_id, version, mime_out)
+    if f is not None:
+        with f:
+            f.seek(start)
+            remaining = None if end is None else end + 1 - start
+            while remaining is None or remaining > 0:
+                chunk = f.read(chunk_size if remaining is None
+                               else min(chunk_size, remaining))
+                if not chunk:
+                    return
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+        return
+    if start or end is not None:  # partial contents aren't cached
+        yield from _iter_drive_chunks(file_id, mime_orig, chunk_size,
+                                      start, end)
+        return
+    writer = CONTENT_CACHE.writer(file_id, version, mime_out)
+    try:
+        for chunk in _iter_drive_chunks(file_id, mime_orig, chunk_size):
+            writer.write(chunk)
+            yield chunk
+    except BaseException:  # includes GeneratorExit on early close
+        writer.discard()
+        raise
+    writer.commit()
+
+
+def _cache_version(modified):
+    """Get canonical cache version for modifiedTime string or parsed timestamp.
+
+    Listings hold parsed (naive UTC) timestamps and metadata requests give
+    RFC 3339 strings; both must give the same cache key for the same file.
+    """
+    if modified is None or pd.isnull(modified):
+        return None
+    if isinstance(modified, str):
+        modified = parse_timestamp_str(modified)
+    return pd.Timestamp(modified).isoformat()
+
+
+def _iter_drive_chunks(file_id, mime_orig, chunk_size, start=0, end=None):
+    """Yield file contents from Drive. See iter_file_chunks."""
+    from .admin import SERVICE_HANDLES, get_thread_http
+    _, mime_out, export = get_export_format('', mime_orig)
+    collection = SERVICE_HANDLES['files'].files()
+    http = get_thread_http()
+    if export:
+        request = collection.export_media(fileId=file_id, mimeType=mime_out)
+        request.http = http
+        fh = io.BytesIO()
+        downloader = MediaIoBaseDownload(fh, request, chunksize=chunk_size)
+        done = False
+        while done is False:
+            status, done = downloader.next_chunk()
+            chunk = fh.getvalue()
+            fh.seek(0)
+            fh.truncate()
+            if chunk:
+                yield chunk
+        return
+    request = collection.get_media(fileId=file_id)
+    offset = start
+    while end is None or offset <= end:
+        last = offset + chunk_size - 1
+        if end is not None:
+            last = min(last, end)
+        resp, content = http.request(
+            request.uri, 'GET',
+            headers={'Range': 'bytes={}-{}'.format(offset, last)})
+        if resp.status == 416:  # start beyond end of file
+            return
+        if resp.status not in (200, 206):
+            raise HttpError(resp, content, uri=request.uri)
+        if content:
+            yield content
+        offset += len(content)
+        total = resp.get('content-range', '').rpartition('/')[2]
+        if resp.status == 200 or not content or \
+                (total.isdigit() and offset >= int(total)):
+            return
+
+
 def download_file(file_id, title, mime_orig):
     """Download Drive file, converting format if necessary.
 
+    Holds the whole file in memory; prefer iter_file_chunks.
+
     Args:
         file_id (str): Drive file id.
         title (str): Drive file title.
@@ -166,43 +932,117 @@ def download_file(file_id, title, mime_orig):
         filename: file and extension of output file
         mime_out: output mime type
     """
-    from .admin import SERVICE_HANDLES
-    file_id = file_id
-
-    if mime_orig in MIME_MAP:
-        mime_out, extension = MIME_MAP[mime_orig]
-        request = SERVICE_HANDLES['files'].files().export_media(fileId=file_id,
-                                                                mimeType=mime_out)
-        filename = ''.join([title, extension])
-    else:  # direct download
-        request = SERVICE_HANDLES['files'].files().get_media(fileId=file_id)
-        filename = title
-        mime_out = mime_orig
+    filename, mime_out, _ = get_export_format(title, mime_orig)
     fh = io.BytesIO()
-    downloader = MediaIoBaseDownload(fh, request)
-    done = False
-    while done is False:
-        status, done = downloader.next_chunk()
-        # print("Download %d%%." % int(status.progress() * 100))
+    for chunk in iter_file_chunks(file_id, mime_orig):
+        fh.write(chunk)
     logger.info('Downloaded {}'.format(title))
     return fh, filename, mime_out
 
 
+class _ZipSink(io.RawIOBase):
+    """Unseekable file object collecting zip output, for streaming."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self):
+        """Get and clear bytes written so far."""
+        chunks, self._chunks = self._chunks, []
+        return b''.join(chunks)
+
+
+_FILE_DONE = object()
+
+
+def stream_folder_zip(files_df, max_workers=4, chunk_size=DOWNLOAD_CHUNK_SIZE,
+                      prefetch_chunks=4):
+    """Yield zip archive of files as bytes chunks, e.g. for a streaming response.
+
+    Files are written in order, while up to max_workers files are downloaded
+    concurrently. Each download holds at most prefetch_chunks chunks ahead
+    of the writer, so memory use does not depend on file or folder size.
+
+    Args:
+        files_df (pd.DataFrame): files, with id, title and mimeType columns.
+        max_workers (int): concurrent file downloads.
+        chunk_size (int): bytes per download request.
+        prefetch_chunks (int): chunks buffered per downloading file.
+    """
+    # listings may be stale, so cache versions come from current metadata
+    versions = _request_modified_times(list(files_df['id']))
+    rows = list(files_df[['id', 'title', 'mimeType']]
+                .assign(version=versions).itertuples(index=False))
+    queues = [queue.Queue(maxsize=prefetch_chunks) for _ in rows]
+    stop = threading.Event()  # set if client disconnects or writing fails
+
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def fetch(i):
+        if stop.is_set():
+            return
+        row = rows[i]
+        try:
+            for chunk in iter_file_chunks(row.id, row.mimeType, chunk_size,
+                                          version=row.version):
+                if not put(queues[i], chunk):
+                    return
+            put(queues[i], _FILE_DONE)
+        except Exception as e:
+            put(queues[i], e)
+
+    sink = _ZipSink()
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        # files are fetched in order, so the file being written is always
+        # being downloaded
+        for i in range(len(rows)):
+            executor.submit(fetch, i)
+        with zipfile.ZipFile(sink, 'w') as f:
+            for row, q in zip(rows, queues):
+                filename, _, _ = get_export_format(row.title, row.mimeType)
+                logger.info('Adding to zip: {}'.format(row.title))
+                with f.open(filename, 'w', force_zip64=True) as entry:
+                    while True:
+                        item = q.get()
+                        if item is _FILE_DONE:
+                            break
+                        if isinstance(item, Exception):
+                            raise item
+                        entry.write(item)
+                        data = sink.drain()
+                        if data:
+                            yield data
+        yield sink.drain()  # remaining entry data and central directory
+    finally:
+        stop.set()
+        executor.shutdown(wait=False)
+
+
 def download_folder_zip(files_df):
     """Combine all files into single zip file stream to send to user.
 
+    Holds the whole archive in memory; prefer stream_folder_zip.
+
     Returns:
         zipped_file (io.BytesIO): zip file buffer.
     """
-    import io
-    import zipfile
-
     zipped_file = io.BytesIO()
-    with zipfile.ZipFile(zipped_file, 'w') as f:
-        for ind, r in files_df.iterrows():
-            logger.info('Adding to zip: {}'.format(r.title))
-            fh, filename, mime_out = download_file(r.id, r.title, r.mimeType)
-            f.writestr(filename, fh.getvalue())
-
+    for chunk in stream_folder_zip(files_df):
+        zipped_file.write(chunk)
+    zipped_file.seek(0)
     return zipped_file
-
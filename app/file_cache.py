@@ -0,0 +1,144 @@
+import os
+import hashlib
+import logging
+import tempfile
+import time
+import threading
+from collections import OrderedDict
+
+
+logger = logging.getLogger(__name__)
+
+TMP_MAX_AGE = 24 * 3600  # seconds before partial writes count as abandoned
+
+
+class FileCache:
+    """Disk cache of file contents, with a byte budget and LRU eviction.
+
+    Entries are keyed by (file_id, version, mime), where version is e.g. the
+    Drive modifiedTime, so a changed file misses the cache and its stale
+    entry is removed once the new version is stored. Entries are written to a
+    temporary file and renamed into place, so readers only see complete
+    files. Evicted files are unlinked; readers holding them open keep their
+    data. Several processes may share a cache directory, each enforcing the
+    budget for the entries it knows about.
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # {name: size}, most recently used last
+        os.makedirs(root, exist_ok=True)
+        self._load_index()
+
+    @staticmethod
+    def entry_name(file_id, version, mime):
+        digest = hashlib.sha1('{}|{}'.format(version, mime).encode())
+        return '{}-{}'.format(file_id, digest.hexdigest()[:16])
+
+    def open(self, file_id, version, mime):
+        """Get binary file object for cached entry, or None on a miss."""
+        name = self.entry_name(file_id, version, mime)
+        path = os.path.join(self.root, name)
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            with self._lock:
+                self._entries.pop(name, None)  # evicted by another process
+            return None
+        os.utime(f.fileno())  # persist recency for reloads of the index
+        with self._lock:
+            # entries written by other processes are adopted here
+            self._entries[name] = os.fstat(f.fileno()).st_size
+            self._entries.move_to_end(name)
+        return f
+
+    def writer(self, file_id, version, mime):
+        """Get CacheWriter for storing a new entry."""
+        return CacheWriter(self, file_id,
+                           self.entry_name(file_id, version, mime))
+
+    @property
+    def size(self):
+        with self._lock:
+            return sum(self._entries.values())
+
+    def _load_index(self):
+        entries = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            stat = os.stat(path)
+            if name.startswith('.tmp-'):
+                if time.time() - stat.st_mtime > TMP_MAX_AGE:
+                    os.remove(path)  # left by an interrupted write
+                continue
+            entries.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self._entries[name] = size
+        self._evict()
+
+    def _add(self, file_id, name, tmp_path, size):
+        os.replace(tmp_path, os.path.join(self.root, name))
+        with self._lock:
+            stale = [i for i in self._entries
+                     if i.rpartition('-')[0] == file_id and i != name]
+            for i in stale:  # previous versions of the same file
+                self._remove(i)
+            self._entries[name] = size
+            self._entries.move_to_end(name)
+            self._evict()
+        logger.debug("Cached %s (%d bytes).", name, size)
+
+    def _evict(self):
+        """Remove least recently used entries to fit in the budget."""
+        total = sum(self._entries.values())
+        while self._entries and total > self.max_bytes:
+            name = next(iter(self._entries))
+            total -= self._entries[name]
+            self._remove(name)
+
+    def _remove(self, name):
+        self._entries.pop(name, None)
+        try:
+            os.remove(os.path.join(self.root, name))
+        except FileNotFoundError:
+            pass
+
+
+class CacheWriter:
+    """Write a new cache entry incrementally, then commit or discard it.
+
+    Entries that grow beyond the cache budget are discarded.
+    """
+
+    def __init__(self, cache, file_id, name):
+        self.cache = cache
+        self.file_id = file_id
+        self.name = name
+        self.size = 0
+        fd, self.tmp_path = tempfile.mkstemp(prefix='.tmp-', dir=cache.root)
+        self._file = os.fdopen(fd, 'wb')
+
+    def write(self, data):
+        if self._file is None:
+            return
+        self.size += len(data)
+        if self.size > self.cache.max_bytes:
+            self.discard()
+            return
+        self._file.write(data)
+
+    def commit(self):
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        self.cache._add(self.file_id, self.name, self.tmp_path, self.size)
+
+    def discard(self):
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        os.remove(self.tmp_path)
@@ -3,7 +3,7 @@ from datetime import datetime
 
 from flask_login import UserMixin
 
-from . import db, lm, name_dict
+from . import db, lm, name_dict, name_emails
 
 
 logger = logging.getLogger(__name__)
@@ -43,8 +43,8 @@ class User(UserMixin, db.Model):
     @property
     def known_emails(self):
         """Get set of all known emails for this user."""
-        name_emails = {i for i in name_dict if name_dict[i] == self.use_name}
-        return {self.email}.union(set(self.alt_emails)).union(name_emails)
+        same_name = name_emails.get(self.use_name, set())
+        return {self.email}.union(self.alt_emails).union(same_name)
 
 
 @lm.user_loader
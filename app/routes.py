@@ -1,17 +1,19 @@
 import logging
 
-from flask import redirect, url_for, render_template, flash, abort, g, request
+from flask import redirect, url_for, render_template, flash, abort, g, \
+    request, jsonify, Response
+from werkzeug.urls import url_quote
 from flask_login import login_user, logout_user,\
     current_user
 
-from app import app, db, OAuthSignIn, update_table_dict, update_members_dict, \
-    update_name_dict
-from .asana import update_asana_ids, update_projects_listing, \
-    get_asana_id_for_user, load_user_assigned_tasks, \
-    get_task_dict_for_user, projects, update_tasks_links
+from app import app, db, OAuthSignIn
+from .asana import get_asana_id_for_user, load_user_assigned_tasks, \
+    get_task_dict_for_user, get_snapshot
 from .models import User
 from .decorators import membership_required
 from .admin import find_user_by_email
+from .scheduler import scheduler
+from .asana_webhooks import handle_webhook
 
 
 _logger = logging.getLogger(__name__)
@@ -20,28 +22,42 @@ _logger = logging.getLogger(__name__)
 @app.route('/reload')
 @membership_required
 def reload_all_data():
-    update_table_dict()
-    update_members_dict()
-    update_name_dict()
-    update_asana_ids()
-    update_projects_listing()
-    update_tasks_links()
-    n_members = len(g.members_dict)
-    msg = 'Members list and tasks updated ({} members).'.format(n_members)
+    job = scheduler.trigger('reload_all')
+    msg = 'Members list and tasks are being updated (job {}).'.format(job.job_id)
     flash(msg, 'message')
-    return render_template('reload.html')
+    return render_template('reload.html', job=job)
 
 
 @app.route('/update-tasks')
 @membership_required
 def update_tasks():
-    update_projects_listing()
-    update_tasks_links()
-    msg = 'Task list updated.'
+    project_id = request.args.get('project')
+    if project_id:
+        job = scheduler.trigger('update_project', project_id)
+    else:
+        job = scheduler.trigger('update_tasks')
+    msg = 'Task list is being updated (job {}). Refresh shortly.'.format(job.job_id)
     flash(msg, 'message')
     return redirect(url_for('asana_tasks'))
 
 
+@app.route('/jobs/<job_id>')
+@membership_required
+def job_status(job_id):
+    job = scheduler.get_job(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job.to_dict())
+
+
+@app.route('/asana/webhook/<project_id>', methods=['POST'])
+def asana_webhook(project_id):
+    """Receive Asana webhook handshakes and events (no login)."""
+    status, headers = handle_webhook(project_id, request.headers,
+                                     request.get_data())
+    return '', status, headers
+
+
 @app.route('/',  methods=['POST', 'GET'])
 def index():
     if not (current_user.is_authenticated and current_user.in_cgem):
@@ -50,6 +66,7 @@ def index():
     user = find_user_by_email(email) if email else None
     user = user if user else current_user
     my_tasks = load_user_assigned_tasks(user)
+    projects = get_snapshot().projects
     abbrv_colors = projects.set_index('name')[['abbrev', 'hex_color']]\
         .apply(lambda r: tuple(r), axis=1).to_dict()
     return render_template("index.html", cal=g.cal, docs=g.recent_docs,
@@ -151,6 +168,72 @@ def show_single_compound(compound_safe):
                            col_dict=SINGLE_COL_DICT)
 
 
+@app.route('/compounds/<compound_safe>/zip',  methods=['GET'])
+@membership_required
+def get_compound_zip(compound_safe):
+    """Stream zip archive of all files for compound."""
+    from .compounds import COMPOUNDS
+    from .drive import stream_folder_zip
+    c = COMPOUNDS['all'].loc[lambda v: v.compound_safe == compound_safe]
+    if not len(c):
+        abort(404)
+    filename = '{}.zip'.format(compound_safe)
+    return Response(stream_folder_zip(c), mimetype='application/zip',
+                    headers={'Content-Disposition':
+                             'attachment; filename="{}"'.format(filename)})
+
+
+def _attachment_header(filename):
+    """Get Content-Disposition value for download of file, per RFC 6266.
+
+    Non-ascii names (e.g. with Greek letters) are sent in the filename*
+    parameter, with an ascii approximation for older clients.
+    """
+    fallback = filename.encode('ascii', 'ignore').decode() \
+        .replace('\\', '_').replace('"', "'")
+    return "attachment; filename=\"{}\"; filename*=UTF-8''{}".format(
+        fallback, url_quote(filename, safe=''))
+
+
+@app.route('/download/<file_id>',  methods=['GET'])
+@membership_required
+def download(file_id):
+    """Stream Drive file to client, supporting Range requests."""
+    from googleapiclient.errors import HttpError
+    from .drive import get_file_metadata, get_export_format, iter_file_chunks
+    try:
+        meta = get_file_metadata(file_id)
+    except HttpError as e:
+        if e.resp.status in (400, 403, 404):  # unknown or inaccessible
+            abort(404)
+        raise
+    filename, mime_out, export = get_export_format(meta['name'],
+                                                   meta['mimeType'])
+    if not export and meta['mimeType'].startswith('application/vnd.google-apps.'):
+        abort(404)  # no content to download, e.g. folders, Forms, shortcuts
+    headers = {'Content-Disposition': _attachment_header(filename)}
+    size = int(meta['size']) if 'size' in meta else None
+    start, end, status = 0, None, 200
+    if size is not None:
+        headers['Accept-Ranges'] = 'bytes'
+        # multiple ranges are not supported: send the full file instead
+        single = request.range is not None and len(request.range.ranges) == 1
+        byte_range = request.range.range_for_length(size) if single else None
+        if single and byte_range is None:
+            return Response(status=416,
+                            headers={'Content-Range': 'bytes */{}'.format(size)})
+        if byte_range is not None:
+            start, stop = byte_range
+            end, status = stop - 1, 206
+            headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, end,
+                                                               size)
+        headers['Content-Length'] = str((size if end is None else end + 1)
+                                        - start)
+    chunks = iter_file_chunks(file_id, meta['mimeType'], start=start, end=end,
+                              version=meta['modifiedTime'])
+    return Response(chunks, status=status, mimetype=mime_out, headers=headers)
+
+
 @app.route('/reload-compounds',  methods=['GET'])
 @membership_required
 def reload_compounds():
@@ -165,6 +248,7 @@ def reload_compounds():
 @membership_required
 def asana_tasks():
     """Show all unassigned and user-assigned tasks."""
+    projects = get_snapshot().projects
     color_dict = projects[['name', 'hex_color']]\
         .set_index('name')['hex_color'].to_dict()
     _logger.info("color_dict: %s", color_dict)
@@ -0,0 +1,165 @@
+import time
+import uuid
+import queue
+import logging
+import threading
+from datetime import datetime, timedelta
+from collections import OrderedDict
+
+from . import app
+
+
+logger = logging.getLogger(__name__)
+
+
+class Job:
+    """Record of a single run of a named refresh."""
+
+    def __init__(self, name, args=()):
+        self.job_id = uuid.uuid4().hex
+        self.name = name
+        self.args = tuple(args)
+        self.status = 'queued'  # queued, running, done, failed
+        self.created = datetime.utcnow()
+        self.started = None
+        self.finished = None
+        self.error = None
+
+    def to_dict(self):
+        return {
+            'job_id': self.job_id,
+            'name': self.name,
+            'args': list(self.args),
+            'status': self.status,
+            'created': self.created.isoformat(),
+            'started': self.started.isoformat() if self.started else None,
+            'finished': self.finished.isoformat() if self.finished else None,
+            'error': self.error,
+        }
+
+
+class RefreshScheduler:
+    """Run named refresh functions in a background worker thread.
+
+    Jobs run one at a time, so refreshes never overlap. Triggering a refresh
+    that is already queued or running returns the existing job (single-flight).
+    Refreshes with an interval are also triggered periodically.
+    """
+    max_history = 100
+
+    def __init__(self):
+        self.refreshes = OrderedDict()  # {name: (func, interval_minutes)}
+        self.jobs = OrderedDict()  # {job_id: Job}, most recent last
+        self._active = {}  # {(name, *args): Job} for queued or running jobs
+        self._last_run = {}  # {name: datetime}
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._started = False
+
+    def register(self, name, func, interval_minutes=0):
+        """Add refresh function. interval_minutes=0 disables periodic runs."""
+        self.refreshes[name] = (func, interval_minutes)
+
+    def trigger(self, name, *args):
+        """Queue refresh by name, unless already queued or running.
+
+        Args:
+            name (str): registered refresh name.
+            *args: arguments for refresh function. Runs with different
+                arguments are separate jobs.
+        Returns:
+            Job: new or existing job for refresh.
+        """
+        if name not in self.refreshes:
+            raise KeyError('Unknown refresh: {}'.format(name))
+        key = (name,) + args
+        with self._lock:
+            if key in self._active:
+                return self._active[key]
+            job = Job(name, args)
+            self._active[key] = job
+            self.jobs[job.job_id] = job
+            while len(self.jobs) > self.max_history:
+                self.jobs.popitem(last=False)
+        self._queue.put(job)
+        return job
+
+    def get_job(self, job_id):
+        return self.jobs.get(job_id)
+
+    def start(self):
+        """Start worker and interval timer threads."""
+        if self._started:
+            return
+        self._started = True
+        threading.Thread(target=self._work, name='refresh-worker',
+                         daemon=True).start()
+        threading.Thread(target=self._tick, name='refresh-timer',
+                         daemon=True).start()
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            func, _ = self.refreshes[job.name]
+            job.status = 'running'
+            job.started = datetime.utcnow()
+            logger.info("Starting refresh %s (job %s).", job.name, job.job_id)
+            try:
+                with app.app_context():
+                    func(*job.args)
+                job.status = 'done'
+            except Exception as e:
+                logger.exception("Refresh %s failed.", job.name)
+                job.status = 'failed'
+                job.error = str(e)
+            job.finished = datetime.utcnow()
+            self._last_run[job.name] = job.finished
+            with self._lock:
+                self._active.pop((job.name,) + job.args, None)
+            logger.info("Finished refresh %s (%s).", job.name, job.status)
+
+    def _tick(self, poll_seconds=30):
+        started = datetime.utcnow()
+        while True:
+            time.sleep(poll_seconds)
+            now = datetime.utcnow()
+            for name, (_, interval) in self.refreshes.items():
+                if not interval:
+                    continue
+                last_run = self._last_run.get(name, started)
+                if now - last_run >= timedelta(minutes=interval):
+                    self.trigger(name)
+
+
+def reload_all():
+    """Refresh members, tables, names and all Asana data."""
+    from . import update_table_dict, update_members_dict, update_name_dict
+    from .asana import update_asana_ids, update_projects_listing, \
+        update_tasks_links
+    update_table_dict()
+    update_members_dict()
+    update_name_dict()
+    update_asana_ids()
+    update_projects_listing()
+    update_tasks_links()
+
+
+def update_tasks():
+    """Refresh Asana projects and (incrementally) tasks."""
+    from .asana import update_projects_listing, update_tasks_links
+    update_projects_listing()
+    update_tasks_links(incremental=True)
+
+
+def update_project(project_id):
+    """Refresh all tasks for a single Asana project."""
+    from .asana import update_project_tasks
+    update_project_tasks(project_id)
+
+
+scheduler = RefreshScheduler()
+scheduler.register('reload_all', reload_all,
+                   app.config['REFRESH_ALL_MINUTES'])
+scheduler.register('update_tasks', update_tasks,
+                   app.config['REFRESH_TASKS_MINUTES'])
+scheduler.register('update_project', update_project)
@@ -0,0 +1,166 @@
+import os
+import json
+import shutil
+import logging
+import tempfile
+import threading
+import time
+
+from pyarrow import feather
+
+
+logger = logging.getLogger(__name__)
+
+TMP_MAX_AGE = 3600  # seconds before partial writes count as abandoned
+
+
+class SnapshotStore:
+    """Versioned store of dataframe tables, published atomically.
+
+    Each generation is a directory holding one feather file per table plus a
+    meta.json file. A generation is written to a temporary directory, renamed
+    into place, and then published by atomically replacing the CURRENT
+    pointer file. Readers and restarts therefore only see complete
+    generations, even if a write is interrupted. Files are fsynced before
+    they are published, so this also holds after a crash.
+    """
+    pointer_name = 'CURRENT'
+    meta_name = 'meta.json'
+
+    def __init__(self, root, keep=3):
+        self.root = root
+        self.keep = keep  # number of generations kept on disk
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self._remove_stale_tmp()
+
+    def current_generation(self):
+        """Get name of published generation, or None if nothing published."""
+        pointer = os.path.join(self.root, self.pointer_name)
+        if not os.path.exists(pointer):
+            return None
+        with open(pointer) as f:
+            return f.read().strip() or None
+
+    def path(self, generation, name):
+        """Get path of table file in generation."""
+        return os.path.join(self.root, generation, name + '.feather')
+
+    def read(self, generation=None, skip=()):
+        """Load tables of generation (default: published) into memory.
+
+        Args:
+            generation (str): generation name. Defaults to published.
+            skip (iterable): names of tables not to load, e.g. tables that
+                are read on demand via path(). Names ending in '-' skip all
+                tables with that prefix.
+        Returns:
+            generation (str): generation name, or None if nothing published.
+            tables (dict): {table_name: pd.DataFrame}.
+            meta (dict): metadata stored with generation.
+        """
+        generation = generation or self.current_generation()
+        if generation is None:
+            return None, {}, {}
+        gen_dir = os.path.join(self.root, generation)
+        prefixes = tuple(i for i in skip if i.endswith('-'))
+        tables = {}
+        for file_name in sorted(os.listdir(gen_dir)):
+            name, ext = os.path.splitext(file_name)
+            if ext != '.feather' or name in skip or \
+                    (prefixes and name.startswith(prefixes)):
+                continue
+            path = os.path.join(gen_dir, file_name)
+            tables[name] = feather.read_feather(path)
+        with open(os.path.join(gen_dir, self.meta_name)) as f:
+            meta = json.load(f)
+        return generation, tables, meta
+
+    def write(self, tables, meta=None, carry=()):
+        """Write and publish a new generation.
+
+        Args:
+            tables (dict): {table_name: pd.DataFrame} to write. Dataframes
+                must have a default index (as required by feather).
+            meta (dict): json-serializable metadata.
+            carry (iterable): names of unchanged tables to carry over from the
+                published generation (hard-linked, not rewritten).
+        Returns:
+            generation (str): name of published generation.
+        """
+        with self._lock:
+            previous = self.current_generation()
+            generation = 'gen-{:06d}'.format(self._last_number() + 1)
+            tmp_dir = tempfile.mkdtemp(prefix='.tmp-', dir=self.root)
+            try:
+                for name in carry:
+                    if previous is None:
+                        break
+                    src = os.path.join(self.root, previous, name + '.feather')
+                    if os.path.exists(src):
+                        os.link(src, os.path.join(tmp_dir, name + '.feather'))
+                for name, df in tables.items():
+                    path = os.path.join(tmp_dir, name + '.feather')
+                    df.to_feather(path)
+                    _fsync_path(path)
+                with open(os.path.join(tmp_dir, self.meta_name), 'w') as f:
+                    json.dump(meta or {}, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                _fsync_path(tmp_dir)
+                os.rename(tmp_dir, os.path.join(self.root, generation))
+            except Exception:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                raise
+            self._write_pointer(generation)
+            self._prune()
+        logger.info("Published snapshot %s in %s.", generation, self.root)
+        return generation
+
+    def _generations(self):
+        return sorted(i for i in os.listdir(self.root) if i.startswith('gen-'))
+
+    def _last_number(self):
+        generations = self._generations()
+        return int(generations[-1][4:]) if generations else 0
+
+    def _write_pointer(self, generation):
+        fd, tmp_path = tempfile.mkstemp(prefix='.tmp-', dir=self.root)
+        with os.fdopen(fd, 'w') as f:
+            f.write(generation)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, os.path.join(self.root, self.pointer_name))
+        _fsync_path(self.root)  # persist renames of generation and pointer
+
+    def _prune(self):
+        """Remove old generations. Memory-mapped readers keep their data."""
+        for generation in self._generations()[:-self.keep]:
+            shutil.rmtree(os.path.join(self.root, generation),
+                          ignore_errors=True)
+
+    def _remove_stale_tmp(self):
+        """Remove generations and pointers left by interrupted writes."""
+        for name in os.listdir(self.root):
+            if not name.startswith('.tmp-'):
+                continue
+            path = os.path.join(self.root, name)
+            try:
+                if time.time() - os.stat(path).st_mtime <= TMP_MAX_AGE:
+                    continue  # may be in progress in another process
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+            except FileNotFoundError:
+                continue  # removed by another process
+            logger.info("Removed stale snapshot temp file %s.", name)
+
+
+def _fsync_path(path):
+    """Flush file or directory at path to disk."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -0,0 +1,89 @@
+"""Micro-benchmark of Drive folder path materialization (get_folder_paths).
+
+Builds a synthetic 20k-folder tree and times get_folder_paths against the
+previous per-folder networkx shortest_path lookups, checking that both give
+the same paths. networkx is no longer a dependency; without it, only the
+current implementation is timed.
+
+Run from the repository root, in the portal environment (the app package
+reads its .env on import):
+
+    python -m benchmarks.folder_paths [n_folders]
+"""
+import sys
+import random
+import timeit
+from collections import OrderedDict
+
+from app.drive import get_folder_paths
+
+try:
+    import networkx as nx
+except ImportError:
+    nx = None
+
+
+class SyntheticFolder:
+    """Stand-in for drive.Folder, with {id: title} of sub-folders."""
+
+    def __init__(self):
+        self.folders = OrderedDict()
+        self.files = []
+
+
+def make_tree(n_folders=20000, seed=0):
+    """Get folder_dict, title_dict for a synthetic tree.
+
+    Most folders are added under recent folders, giving deep branches, and
+    the rest under any folder, giving bushy levels.
+    """
+    rng = random.Random(seed)
+    folder_dict = {'root': SyntheticFolder()}
+    title_dict = {'root': 'ROOT'}
+    folder_ids = ['root']
+    for i in range(n_folders):
+        folder_id = 'F{}'.format(i)
+        if rng.random() < 0.7:
+            parent_id = rng.choice(folder_ids[-200:])
+        else:
+            parent_id = rng.choice(folder_ids)
+        title = 'folder {}'.format(i)
+        folder_dict[parent_id].folders[folder_id] = title
+        folder_dict[folder_id] = SyntheticFolder()
+        title_dict[folder_id] = title
+        folder_ids.append(folder_id)
+    return folder_dict, title_dict
+
+
+def get_folder_paths_nx(folder_dict, title_dict):
+    """Previous implementation: one shortest_path search per folder."""
+    edges = []
+    for this_id in folder_dict:
+        edges.extend((this_id, k) for k in folder_dict[this_id].folders)
+    graph = nx.DiGraph()
+    graph.add_edges_from(edges)
+    return {folder_id: [title_dict[i] for i in
+                        nx.shortest_path(graph, 'root', folder_id)]
+            for folder_id in folder_dict}
+
+
+def main(n_folders=20000, repeat=3):
+    folder_dict, title_dict = make_tree(n_folders)
+    t_new = min(timeit.repeat(lambda: get_folder_paths(folder_dict, title_dict),
+                              number=1, repeat=repeat))
+    paths = get_folder_paths(folder_dict, title_dict)
+    print('{} folders (max depth {}), best of {}: top-down pass {:.3f}s'.format(
+        len(folder_dict), max(map(len, paths.values())), repeat, t_new))
+    if nx is None:
+        print('networkx not installed: skipping previous implementation.')
+        return
+    assert get_folder_paths_nx(folder_dict, title_dict) == paths
+    t_old = min(timeit.repeat(
+        lambda: get_folder_paths_nx(folder_dict, title_dict),
+        number=1, repeat=repeat))
+    print('networkx shortest paths {:.3f}s ({:.0f}x)'.format(t_old,
+                                                              t_old / t_new))
+
+
+if __name__ == '__main__':
+    main(*[int(i) for i in sys.argv[1:2]])